@@ -390,7 +390,7 @@ class FetchThread(threading.Thread):
         super().__init__(target=target, args=(self.bcapi,))
 
     def stop(self):
-        self.bcapi.stop_fetch = True
+        self.bcapi.stop()
 
 class Application(ttk.Frame):
     """
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+#   Copyright 2020 Sarubee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+ bc-fetch.py
+ - headless program to fetch Buffett Code API data (for cron / daemon)
+
+ NOTE: サーバー上で動かすので tkinter, matplotlib は import しないこと
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+import logging
+logger = logging.getLogger(__name__)
+
+from bc_api import BCAPI, BCRateLimiter, BCResponseCache
+from bc_data import BCData
+from bc_scheduler import BCFetchScheduler
+
+# 終了コード
+EXIT_OK = 0
+EXIT_FAILED = 1       # 失敗したジョブがある
+EXIT_USAGE = 2        # 引数・設定の誤り (argparse と同じ)
+EXIT_QUOTA = 3        # quota が足りず取得しきれなかった (残りは次回)
+EXIT_INTERRUPTED = 130 # SIGINT, SIGTERM で中断した
+
+MODES = ["company", "quarter", "indicator", "daily"]
+
+def _read_api_key(args):
+    if args.key_file is not None:
+        with open(args.key_file) as f:
+            return f.read().strip()
+    return os.environ.get("BC_API_KEY")
+
+def _write_status(path, status):
+    """状態ファイルを書き出す (読み手が途中の状態を見ないよう置き換える)"""
+    if path is None:
+        return
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(status, f, ensure_ascii=False, indent=4, default=str)
+    os.replace(tmp, path)
+
+def _job_status(job):
+    d = {
+        "root_dir" : str(job.root_dir),
+        "mode" : job.mode,
+        "priority" : job.priority,
+        "status" : job.status,
+        "error" : None if job.error is None else f"{type(job.error).__name__}: {job.error}",
+    }
+    if isinstance(job.result, list):
+        d["deferred"] = len(job.result)
+    if isinstance(job.result, dict):
+        # company の前回との差分
+        d["universe"] = {k : len(v) for k, v in job.result.items()}
+    if job.api is not None:
+        d["stats"] = job.api.stats.summary()
+    return d
+
+def _mode_kwargs(args, mode):
+    """BCData.fetch_{mode}() に渡す期間などの引数"""
+    if mode == "quarter":
+        return {"start" : args.quarter_start, "end" : args.quarter_end, "incremental" : args.incremental, "added_only" : args.added_only}
+    if mode == "daily":
+        return {"start" : args.daily_start, "end" : args.daily_end, "incremental" : args.incremental, "added_only" : args.added_only}
+    if mode == "indicator":
+        return {"added_only" : args.added_only}
+    return {}
+
+def _estimate(args, api_key, limiter):
+    """
+    取得にかかるリクエスト数・時間・quota の見込みを表示する (API は呼ばない)
+
+    Returns
+    -------
+    int
+        終了コード
+    """
+    cache = BCResponseCache(args.cache_dir) if args.cache_dir is not None else None
+    api = BCAPI(api_key, limiter=limiter, url_api=args.url_api, cache=cache)
+    rows = []
+    total = 0
+    unknown = False
+    for root_dir in args.root_dirs:
+        data = BCData(root_dir)
+        for mode in args.modes:
+            if mode != "company" and data.company is None:
+                # 会社一覧がないと銘柄数がわからない
+                rows.append((root_dir, mode, "-", "-", "-", "-", "company data is required"))
+                unknown = True
+                continue
+            e = data.estimate(api, mode, overwrite=args.overwrite, **_mode_kwargs(args, mode))
+            total += e["num_requests"]
+            rows.append((root_dir, mode, e["num_tickers"], e["num_requests"], e["num_cached"],
+                         timedelta(seconds=round(e["duration"])), ""))
+    api.close()
+
+    print(f"{'root_dir':<40} {'mode':<10} {'tickers':>8} {'requests':>9} {'cached':>7} {'duration':>16}")
+    for root_dir, mode, num_tickers, num_requests, num_cached, duration, note in rows:
+        print(f"{str(root_dir):<40} {mode:<10} {num_tickers:>8} {num_requests:>9} {num_cached:>7} {str(duration):>16} {note}")
+    p = limiter.project(total)
+    print(f"total: {total} requests{' (+ unknown)' if unknown else ''} at {limiter.rate} requests/sec"
+          f", duration: {timedelta(seconds=round(total / limiter.rate))}")
+    print(f"quota: remaining {limiter.remaining()}, {p['num_days']} quota day(s), finish: {p['finish']:%Y-%m-%d %H:%M}")
+    if p["exhausted"] is not None:
+        print(f"quota will be used up at {p['exhausted']:%Y-%m-%d %H:%M}")
+    return EXIT_OK
+
+def _run_once(args, api_key, limiter, stop, status):
+    """
+    全データディレクトリについて 1 回分の取得を行う
+
+    Returns
+    -------
+    int
+        終了コード
+    """
+    api_kwargs = {"num_workers" : args.num_workers}
+    if args.url_api is not None:
+        api_kwargs["url_api"] = args.url_api
+    scheduler = BCFetchScheduler(api_key, limiter=limiter, max_jobs=args.max_jobs, cache_dir=args.cache_dir, **api_kwargs).start()
+    jobs = []
+    for i, root_dir in enumerate(args.root_dirs):
+        # 先に指定したディレクトリほど優先
+        priority = len(args.root_dirs) - i
+        common = {"retry" : args.retry, "overwrite" : args.overwrite}
+        for mode in args.modes:
+            kwargs = {**common, **_mode_kwargs(args, mode)}
+            jobs.append(scheduler.submit(root_dir, mode, priority, **kwargs))
+
+    status["state"] = "running"
+    status["started_at"] = datetime.now()
+    status["finished_at"] = None
+    while not scheduler.wait(timeout=1.0):
+        # 中断されたらスケジューラも止める
+        if stop.is_set():
+            scheduler.stop()
+        status["jobs"] = [_job_status(job) for job in jobs]
+        _write_status(args.status_file, status)
+    scheduler.shutdown()
+
+    status["jobs"] = [_job_status(job) for job in jobs]
+    status["finished_at"] = datetime.now()
+    status["quota_remaining"] = limiter.remaining()
+    if stop.is_set():
+        code = EXIT_INTERRUPTED
+    elif any([job.status == "failed" for job in jobs]):
+        code = EXIT_FAILED
+    elif any([isinstance(job.result, list) and len(job.result) > 0 for job in jobs]) or limiter.remaining() == 0:
+        code = EXIT_QUOTA
+    else:
+        code = EXIT_OK
+    status["exit_code"] = code
+    return code
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="fetch Buffett Code API data without GUI")
+    parser.add_argument("root_dirs", help="root directories", nargs="+", type=lambda s: Path(s).resolve())
+    parser.add_argument("--modes", help=f"comma separated data to fetch (default: all of {','.join(MODES)})", default=",".join(MODES))
+    parser.add_argument("--key-file", help="file containing API key (default: $BC_API_KEY)")
+    parser.add_argument("--quarter-start", help="start year of quarter data", default="2011")
+    parser.add_argument("--quarter-end", help="end year of quarter data", default=str(datetime.now().year))
+    parser.add_argument("--daily-start", help="start year of daily data", default="2017")
+    parser.add_argument("--daily-end", help="end year of daily data", default=str(datetime.now().year))
+    parser.add_argument("--overwrite", help="overwrite existing CSVs", action="store_true")
+    parser.add_argument("--incremental", help="fetch only periods newer than existing CSVs", action="store_true")
+    parser.add_argument("--added-only", help="fetch only tickers newly added to the company list", action="store_true")
+    parser.add_argument("--retry", help="max retry interval [minutes] (negative: no retry)", type=int, default=10)
+    parser.add_argument("--rate", help="requests per second", type=float, default=1.0)
+    parser.add_argument("--daily-quota", help="max requests per day", type=int)
+    parser.add_argument("--quota-spent", help="requests already spent today (at least the count saved in quota.json of the first root directory)", type=int, default=0)
+    parser.add_argument("--num-workers", help="number of concurrent requests", type=int, default=4)
+    parser.add_argument("--max-jobs", help="number of concurrent jobs", type=int, default=2)
+    parser.add_argument("--url-api", help="API URL (ex. bc_mock.py server)")
+    parser.add_argument("--cache-dir", help="response cache shared by all root directories (default: cache/ of the first root directory)", type=Path)
+    parser.add_argument("--status-file", help="status file (JSON)", type=Path)
+    parser.add_argument("--interval", help="run repeatedly at this interval [hours] (daemon mode)", type=float)
+    parser.add_argument("--dry-run", help="only estimate the number of requests, duration and quota days", action="store_true")
+    parser.add_argument("--debug", help="execute this program in debug mode", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level = logging.DEBUG if args.debug else logging.INFO,
+        format = "[%(asctime)s][%(levelname)s] %(message)s",
+    )
+
+    args.modes = [m.strip() for m in args.modes.split(",") if m.strip() != ""]
+    invalid = [m for m in args.modes if m not in MODES]
+    if len(invalid) > 0:
+        parser.error(f"invalid modes: {invalid}")
+    api_key = _read_api_key(args)
+    # 同じ日の別の実行で消費した分は最初のデータディレクトリの quota.json から引き継ぐ
+    quota_state = Path(args.root_dirs[0]) / "quota.json"
+    if args.dry_run:
+        # API は呼ばないのでキーは不要
+        return _estimate(args, api_key or "", BCRateLimiter(rate=args.rate, daily_quota=args.daily_quota, spent=args.quota_spent, state_path=quota_state))
+    if api_key is None or api_key == "":
+        parser.error("API key is required (--key-file or $BC_API_KEY)")
+
+    # SIGINT, SIGTERM で中断 (取得済みの分は journal から再開できる)
+    stop = threading.Event()
+    def _on_signal(signum, frame):
+        logger.warn(f"received signal {signum}, stopping ...")
+        stop.set()
+    signal.signal(signal.SIGINT, _on_signal)
+    signal.signal(signal.SIGTERM, _on_signal)
+
+    # quota は繰り返し実行の間も共有する
+    limiter = BCRateLimiter(rate=args.rate, daily_quota=args.daily_quota, spent=args.quota_spent, state_path=quota_state)
+    status = {"pid" : os.getpid(), "root_dirs" : [str(d) for d in args.root_dirs], "modes" : args.modes, "jobs" : []}
+    while True:
+        code = _run_once(args, api_key, limiter, stop, status)
+        if args.interval is None or code == EXIT_INTERRUPTED:
+            break
+        next_run = datetime.now() + timedelta(hours=args.interval)
+        status["state"] = "waiting"
+        status["next_run"] = next_run
+        _write_status(args.status_file, status)
+        logger.info(f"next run: {next_run:%Y-%m-%d %H:%M:%S}")
+        if stop.wait(args.interval * 3600):
+            code = EXIT_INTERRUPTED
+            break
+
+    status["state"] = "interrupted" if code == EXIT_INTERRUPTED else "finished"
+    status["next_run"] = None
+    _write_status(args.status_file, status)
+    logger.info(f"END (exit code: {code})")
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
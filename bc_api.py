@@ -20,11 +20,24 @@ bc_api.py
 
 import pandas as pd
 import requests
+import json
+import hashlib
+import os
+import shutil
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import heapq
+import itertools
+import copy
 import time
 import math
 from urllib.parse import urljoin
 from pathlib import Path
-import traceback
+import random
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import logging
@@ -35,32 +48,1497 @@ class BCFetchStopped(Exception):
 class BCFetchError(RuntimeError):
     pass
 class BCExceededFetchError(BCFetchError):
+    def __init__(self, message, retry_at=None):
+        super().__init__(message)
+        self.retry_at = retry_at # 再取得可能になる時刻 (不明なら None)
+class BCServerError(BCFetchError):
     pass
+class BCMalformedResponseError(BCFetchError):
+    pass
+
+class BCRetryPolicy:
+    """
+    リトライ方針 (指数バックオフ + jitter)
+
+    Attributes
+    ----------
+    base : float
+        初回リトライまでの待ち時間 [sec]
+    factor : float
+        リトライごとに待ち時間を何倍にするか
+    max_delay : float
+        待ち時間の上限 [sec]
+    jitter : float
+        待ち時間をランダムにずらす割合 (0.1 なら ±10%)
+    max_retries : int
+        最大リトライ回数。None なら無制限
+    """
+
+    def __init__(self, base, factor=2.0, max_delay=3600.0, jitter=0.1, max_retries=None):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retries = max_retries
+
+    def delay(self, n):
+        """n 回目 (0 始まり) のリトライまでの待ち時間 [sec]"""
+        d = min(self.base * self.factor ** n, self.max_delay)
+        return d * (1 + random.uniform(-self.jitter, self.jitter))
+
+class BCRateLimiter:
+    """
+    token bucket によるリクエスト間隔制御と 1 日あたりの取得上限 (quota) 管理
+
+    Attributes
+    ----------
+    rate : float
+        1 秒あたりのリクエスト数
+    burst : int
+        連続して投げられるリクエスト数 (bucket の容量)
+    daily_quota : int
+        1 日あたりのリクエスト上限。None なら上限なし
+    spent : int
+        現在の quota 期間で消費済みのリクエスト数
+    reset_hour : int
+        quota がリセットされる時刻 [hour]
+    reserved : dict
+        {確保した人: 確保済みでまだ使っていないリクエスト数}。reserve() 参照
+    state_path : Path
+        消費数の保存先。別プロセス (cron で毎回起動する場合など) で同じ quota 期間の消費数を引き継ぐ。None なら保存しない
+    """
+
+    def __init__(self, rate=1.0, burst=1, daily_quota=None, spent=0, reset_hour=0, state_path=None):
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.spent = spent
+        self.reset_hour = reset_hour
+        self.reserved = {}
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.waiting = [] # 待っているリクエストの (-優先度, 順番) の heap
+        self.__seq = itertools.count()
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.window_start = self.__window_start(datetime.now())
+        self.state_path = None
+        if state_path is not None:
+            self.attach(state_path)
+
+    def attach(self, state_path):
+        """
+        消費数の保存先を設定し、同じ quota 期間に保存された消費数があれば引き継ぐ
+
+        Parameters
+        ----------
+        state_path : str or Path
+            保存先 (JSON)
+        """
+        with self.lock:
+            self.state_path = Path(state_path)
+            self.__update_window()
+            try:
+                with open(self.state_path, "r") as f:
+                    state = json.load(f)
+                if datetime.fromisoformat(state["window_start"]) == self.window_start:
+                    self.spent = max(self.spent, int(state["spent"]))
+            except FileNotFoundError:
+                pass
+            except (json.JSONDecodeError, KeyError, ValueError, TypeError):
+                logger.warn(f"ignoring broken quota state '{self.state_path}'")
+
+    def __save(self):
+        # lock を取った状態で呼ぶ
+        if self.state_path is None:
+            return
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.state_path.with_name(f"{self.state_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump({"window_start" : self.window_start.isoformat(), "spent" : self.spent}, f)
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            logger.warn(f"could not save quota state '{self.state_path}' ({e})")
+
+    def __window_start(self, now):
+        start = now.replace(hour=self.reset_hour, minute=0, second=0, microsecond=0)
+        if now < start:
+            start -= timedelta(days=1)
+        return start
+
+    def __update_window(self):
+        # quota 期間をまたいだら消費数をリセット
+        now = datetime.now()
+        if now >= self.reset_time():
+            self.window_start = self.__window_start(now)
+            self.spent = 0
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reset_time(self):
+        """次に quota がリセットされる時刻"""
+        return self.window_start + timedelta(days=1)
+
+    def __unreserved(self):
+        return max(self.daily_quota - self.spent - sum(self.reserved.values()), 0)
+
+    def remaining(self):
+        """現在の quota 期間の残りリクエスト数 (上限なしなら None)。他で確保済みの分は除く"""
+        with self.lock:
+            self.__update_window()
+            if self.daily_quota is None:
+                return None
+            return self.__unreserved()
+
+    def reserve(self, owner, num_requests):
+        """
+        owner が使うリクエスト数を quota の残りから確保する。
+        確保した分は owner が acquire() するまで他からは使えない (remaining() にも含まれない)。
+        limiter を共有するジョブが同じ残りを当てにして quota を超えないようにするためのもの。
+
+        Parameters
+        ----------
+        owner : object
+            確保する人 (acquire(), release() に同じものを渡す)
+        num_requests : int
+            確保したいリクエスト数
+
+        Returns
+        -------
+        int
+            確保できたリクエスト数 (quota の残りが足りなければ num_requests より少ない)。
+            quota 未設定なら None
+        """
+        with self.lock:
+            self.__update_window()
+            if self.daily_quota is None:
+                return None
+            n = min(num_requests, self.__unreserved())
+            self.reserved[owner] = self.reserved.get(owner, 0) + n
+            return n
+
+    def release(self, owner):
+        """owner が確保して使わなかった分を返す"""
+        with self.cond:
+            self.reserved.pop(owner, None)
+            self.cond.notify_all()
+
+    def acquire(self, stop_event=None, priority=0, owner=None):
+        """
+        リクエスト 1 回分の枠を確保する。必要な場合のみ待つ。
+        複数のリクエストが待っている場合は優先度の高いもの (同じなら先に来たもの) から枠を渡す。
+
+        Parameters
+        ----------
+        stop_event : threading.Event
+            待っている間に set されたら BCFetchStopped を投げる (set した側で wake() を呼ぶ)
+        priority : int
+            優先度 (大きいほど優先)
+        owner : object
+            reserve() で確保した人。確保した分があればそこから使い、なければ確保されていない残りから使う
+
+        Raises
+        ------
+        BCExceededFetchError
+            quota を使い切っている場合 (サーバーに問い合わせる前に判定する)
+
+        Returns
+        -------
+        float
+            待った時間 [sec]
+        """
+        start = time.perf_counter()
+        with self.cond:
+            ticket = (-priority, next(self.__seq))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    if stop_event is not None and stop_event.is_set():
+                        raise BCFetchStopped()
+                    self.__update_window()
+                    own = self.reserved.get(owner, 0)
+                    if self.daily_quota is not None and (self.spent >= self.daily_quota or (own < 1 and self.__unreserved() < 1)):
+                        raise BCExceededFetchError(f"Daily quota ({self.daily_quota}) is used up", self.reset_time())
+                    self.__refill()
+                    if self.waiting[0] == ticket and self.tokens >= 1:
+                        self.tokens -= 1
+                        self.spent += 1
+                        if own > 0:
+                            self.reserved[owner] = own - 1
+                        self.__save()
+                        return time.perf_counter() - start
+                    if self.waiting[0] == ticket:
+                        # 次の枠ができるまで待つ
+                        self.cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        # 先頭でなければ先頭が枠を取るまで待つ (notify で起こされる)
+                        self.cond.wait()
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+
+    def wake(self):
+        """acquire() で待っているものを起こす (stop_event を set した後に呼ぶ)"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def exceeded(self):
+        """
+        サーバーから取得制限エラーが返ってきた場合に呼ぶ。
+        以降 quota 期間が変わるまでは acquire() で即座にエラーにする。
+
+        Returns
+        -------
+        datetime
+            再取得可能になる時刻 (quota 未設定なら None)
+        """
+        with self.lock:
+            if self.daily_quota is None:
+                return None
+            self.spent = self.daily_quota
+            # 確保済みの分ももう使えない
+            self.reserved = {k : 0 for k in self.reserved}
+            self.__save()
+            return self.reset_time()
+
+    def forecast(self, num_requests, owner=None):
+        """
+        指定回数のリクエストを行った場合の見込みを算出
+
+        Parameters
+        ----------
+        num_requests : int
+            リクエスト回数
+        owner : object
+            reserve() した人。確保済みの分も残りに含める
+
+        Returns
+        -------
+        finish : datetime
+            quota を考慮しない場合の終了見込み時刻
+        exhausted : datetime
+            quota を使い切る見込み時刻。使い切らないなら None
+        """
+        now = datetime.now()
+        finish = now + timedelta(seconds=num_requests / self.rate)
+        remaining = self.remaining()
+        if remaining is not None:
+            with self.lock:
+                remaining += self.reserved.get(owner, 0)
+        if remaining is None or num_requests <= remaining:
+            return finish, None
+        return finish, now + timedelta(seconds=remaining / self.rate)
+
+    def project(self, num_requests):
+        """
+        quota の期間をまたぐ場合も含めて、指定回数のリクエストを行った場合の見込みを算出
+
+        Parameters
+        ----------
+        num_requests : int
+            リクエスト回数
+
+        Returns
+        -------
+        dict
+            * finish : quota のリセット待ちを含めた終了見込み時刻
+            * exhausted : 今の quota 期間の quota を使い切る見込み時刻。使い切らないなら None
+            * num_days : 使う quota 期間の数 (quota なしなら 1 (リクエストなしなら 0))
+        """
+        finish, exhausted = self.forecast(num_requests)
+        remaining = self.remaining()
+        if exhausted is None:
+            return {"finish" : finish, "exhausted" : None, "num_days" : 1 if num_requests > 0 else 0}
+        # 残りは quota のリセットごとに daily_quota ずつ
+        rest = num_requests - remaining
+        n = math.ceil(rest / self.daily_quota)
+        last = rest - (n - 1) * self.daily_quota
+        finish = self.reset_time() + timedelta(days=n - 1, seconds=last / self.rate)
+        return {"finish" : finish, "exhausted" : exhausted, "num_days" : n + (1 if remaining > 0 else 0)}
+
+class BCResponseCache:
+    """
+    API レスポンス (エラーでないもの) のディスクキャッシュ
+
+    endpoint + パラメータ (tickers, from, to) のハッシュをキーにして
+    {cache_dir}/{endpoint}/{ハッシュ先頭2文字}/{ハッシュ}.json に保存する。
+    期限切れのものは prune() で削除する (差分取得では毎日 from, to の違うキーができるため)。
+
+    Attributes
+    ----------
+    cache_dir : Path
+        キャッシュ保存先ディレクトリ
+    """
+
+    # 確定済みの期間 (過去の年度・年) のデータの有効期限
+    TTL_CLOSED = timedelta(days=365)
+    # それ以外の endpoint ごとの有効期限
+    TTL_OPEN = {
+        "quarter" : timedelta(days=1),
+        "daily" : timedelta(hours=12),
+        "indicator" : timedelta(hours=1),
+        "company" : timedelta(days=1),
+    }
+    # キャッシュ全体の上限サイズ [byte]。超えたら古いものから削除する
+    MAX_BYTES = 1 << 30
+    # prune() で実際に削除処理をする間隔
+    PRUNE_INTERVAL = timedelta(days=1)
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    @staticmethod
+    def key(endpoint, params):
+        s = json.dumps({"endpoint" : endpoint, "params" : params}, sort_keys=True)
+        return hashlib.sha256(s.encode()).hexdigest()
+
+    def path(self, endpoint, params):
+        k = BCResponseCache.key(endpoint, params)
+        return self.cache_dir / endpoint / k[:2] / f"{k}.json"
+
+    @staticmethod
+    def ttl(endpoint, params, today=None):
+        """
+        有効期限を決める
+
+        quarter は終了年度が 2 年以上前 (決算発表済み) なら、
+        daily は終了日が今年より前なら確定済みとして長期間有効にする。
+        確定済みかどうかは取得した日 (today) の時点で判定する (取得時にまだ途中だった期間はその後も短期間だけ有効)。
+        """
+        today = today if today is not None else date.today()
+        if endpoint == "quarter" and "to" in params:
+            end_year = int(params["to"].split("Q")[0])
+            if end_year <= today.year - 2:
+                return BCResponseCache.TTL_CLOSED
+        elif endpoint == "daily" and "to" in params:
+            if date.fromisoformat(params["to"]) < date(today.year, 1, 1):
+                return BCResponseCache.TTL_CLOSED
+        return BCResponseCache.TTL_OPEN.get(endpoint, timedelta(0))
+
+    def contains(self, endpoint, params):
+        """有効期限内のキャッシュがあるか (中身は読まない)"""
+        p = self.path(endpoint, params)
+        try:
+            fetched_at = datetime.fromtimestamp(p.stat().st_mtime)
+        except FileNotFoundError:
+            return False
+        return datetime.now() - fetched_at <= BCResponseCache.ttl(endpoint, params, fetched_at.date())
+
+    def get(self, endpoint, params):
+        """
+        キャッシュを取得。なければ (または期限切れなら) None
+        """
+        p = self.path(endpoint, params)
+        try:
+            with open(p, "r") as f:
+                c = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        fetched_at = datetime.fromtimestamp(c["fetched_at"])
+        if datetime.now() - fetched_at > BCResponseCache.ttl(endpoint, params, fetched_at.date()):
+            return None
+        return c["data"]
+
+    def put(self, endpoint, params, d):
+        p = self.path(endpoint, params)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        # 途中で落ちても壊れたファイルが残らないよう一時ファイルに書いてから置き換える
+        tmp = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"endpoint" : endpoint, "params" : params, "fetched_at" : time.time(), "data" : d}, f)
+        os.replace(tmp, p)
+
+    def prune(self, force=False, max_bytes=None):
+        """
+        期限切れのキャッシュを削除し、全体が max_bytes を超えていれば古いものから削除する
+
+        ファイルを全部見るので、force でなければ前回から PRUNE_INTERVAL 経っていない場合は何もしない。
+
+        Parameters
+        ----------
+        force : bool
+            True なら前回からの経過時間に関係なく削除処理をする
+        max_bytes : int
+            全体の上限サイズ [byte]。None なら MAX_BYTES
+
+        Returns
+        -------
+        int
+            削除したファイル数
+        """
+        marker = self.cache_dir / ".pruned"
+        now = time.time()
+        if not self.cache_dir.exists():
+            return 0
+        if not force and marker.exists() and now - marker.stat().st_mtime < BCResponseCache.PRUNE_INTERVAL.total_seconds():
+            return 0
+        marker.touch()
+        max_bytes = max_bytes if max_bytes is not None else BCResponseCache.MAX_BYTES
+
+        removed = 0
+        files = []
+        for p in self.cache_dir.glob("*/*/*"):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            age = timedelta(seconds=now - stat.st_mtime)
+            endpoint = p.parent.parent.name
+            if p.name.endswith(".tmp"):
+                # 書き込み途中で落ちたもの
+                expired = age > BCResponseCache.PRUNE_INTERVAL
+            elif age > BCResponseCache.TTL_CLOSED:
+                expired = True
+            elif age > BCResponseCache.TTL_OPEN.get(endpoint, timedelta(0)):
+                # 確定済みの期間かどうかはパラメータを見ないとわからない
+                try:
+                    with open(p, "r") as f:
+                        params = json.load(f)["params"]
+                    expired = age > BCResponseCache.ttl(endpoint, params, date.fromtimestamp(stat.st_mtime))
+                except FileNotFoundError:
+                    # 同じキャッシュを使う他のジョブが消した
+                    continue
+                except (json.JSONDecodeError, KeyError, ValueError):
+                    expired = True
+            else:
+                expired = False
+            if expired:
+                BCResponseCache.__unlink(p)
+                removed += 1
+            else:
+                files.append((stat.st_mtime, stat.st_size, p))
+
+        total = sum([size for _, size, _ in files])
+        for _, size, p in sorted(files, key=lambda f: f[0]):
+            if total <= max_bytes:
+                break
+            BCResponseCache.__unlink(p)
+            total -= size
+            removed += 1
+        if removed > 0:
+            logger.info(f"pruned {removed} cache files in '{self.cache_dir}' ({total / 1e6:.1f} MB left)")
+        return removed
+
+    @staticmethod
+    def __unlink(p):
+        # 同じキャッシュを使う他のジョブが先に消していてもよい
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+
+class BCFetchJournal:
+    """
+    取得済みチャンク (endpoint, 銘柄グループ, 期間) の追記型ジャーナル
+
+    {journal_dir}/journal.jsonl に 1 行 1 レコードで追記し、取得データ本体は
+    {journal_dir}/payloads/ 以下に置く。中断 (クラッシュ, Stop, quota 切れ) 後に同じジョブを
+    再実行すると、記録済みのチャンクは API を呼ばずにここから返す。
+
+    Attributes
+    ----------
+    journal_dir : Path
+        ジャーナル保存先ディレクトリ
+    job : dict
+        ジョブの識別情報。既存ジャーナルと一致しなければ破棄して作り直す
+    discard : bool
+        False なら一致しない既存ジャーナルを破棄せず無視するだけにする (見積もりなど読むだけの場合)
+    """
+
+    def __init__(self, journal_dir, job, discard=True):
+        self.journal_dir = Path(journal_dir)
+        self.path = self.journal_dir / "journal.jsonl"
+        self.job = json.loads(json.dumps(job)) # 比較できるよう JSON で表せる形にそろえる
+        self.lock = threading.Lock()
+        self.chunks = {} # キー -> payload ファイル名
+        self.done = set() # 後処理まで完了した銘柄
+        self.discard = discard
+
+        if self.path.exists():
+            self.__load()
+        if len(self.chunks) > 0 or len(self.done) > 0:
+            logger.info(f"resuming from journal ({len(self.chunks)} chunks, {len(self.done)} tickers done)")
+
+    def __load(self):
+        with open(self.path, "r") as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, json.JSONDecodeError):
+            header = None
+        if header is None or header.get("job") != self.job:
+            # 別ジョブのジャーナルなので破棄
+            if self.discard:
+                logger.info(f"discarding journal of another job ({self.path})")
+                self.clear()
+            return
+        for line in lines[1:]:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で落ちた最終行は無視
+                continue
+            if "chunk" in rec:
+                self.chunks[rec["chunk"]] = rec["payload"]
+            elif "done" in rec:
+                self.done.add(rec["done"])
+
+    def __append(self, rec):
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            if f.tell() == 0:
+                f.write(json.dumps({"job" : self.job}) + "\n")
+            f.write(json.dumps(rec) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def contains(self, endpoint, params):
+        with self.lock:
+            return BCResponseCache.key(endpoint, params) in self.chunks
+
+    def get(self, endpoint, params):
+        """記録済みチャンクのデータを取得。なければ None"""
+        with self.lock:
+            name = self.chunks.get(BCResponseCache.key(endpoint, params))
+        if name is None:
+            return None
+        try:
+            with open(self.journal_dir / "payloads" / name, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, endpoint, params, d):
+        """取得したチャンクのデータを保存してから記録"""
+        k = BCResponseCache.key(endpoint, params)
+        name = f"{k}.json"
+        p = self.journal_dir / "payloads" / name
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(f"{name}.{threading.get_ident()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(d, f)
+        os.replace(tmp, p)
+        with self.lock:
+            self.__append({"chunk" : k, "endpoint" : endpoint, "params" : params, "payload" : name})
+            self.chunks[k] = name
+
+    def mark_done(self, ticker):
+        """銘柄の後処理 (保存など) が完了したことを記録"""
+        with self.lock:
+            self.__append({"done" : int(ticker)})
+            self.done.add(int(ticker))
+
+    def done_tickers(self):
+        with self.lock:
+            return set(self.done)
+
+    def clear(self):
+        """ジョブ完了時などにジャーナルを削除"""
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
+        self.chunks = {}
+        self.done = set()
+
+class BCRequestPlanner:
+    """
+    銘柄ごとの取得期間から、API の制限 (銘柄数・期間) を守りつつリクエスト数が少なくなるよう取得計画を立てる
+
+    同じリクエスト数で一緒に取得できる銘柄 (取得期間が同じものなど) をまとめ、
+    過去に取得してデータがなかった期間は取得対象から外す。
+
+    Attributes
+    ----------
+    state_path : Path
+        データがなかった期間の記録先。None なら保存しない
+    empty : dict
+        データがなかった期間 {mode: {銘柄コード: [[開始, 終了], ...]}}
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = Path(state_path) if state_path is not None else None
+        self.lock = threading.Lock()
+        self.empty = {}
+        if self.state_path is not None and self.state_path.exists():
+            with open(self.state_path, "r") as f:
+                self.empty = json.load(f)
+
+    def save(self):
+        if self.state_path is None:
+            return
+        with self.lock:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.state_path, "w") as f:
+                json.dump(self.empty, f)
+
+    @staticmethod
+    def shift(mode, p, n):
+        """期間 p (四半期 or 日) を n 期ずらす"""
+        if mode == "quarter":
+            y, q = [int(v) for v in p.split("Q")]
+            i = y * 4 + q - 1 + n
+            return f"{i // 4}Q{i % 4 + 1}"
+        return (date.fromisoformat(p) + timedelta(days=n)).isoformat()
+
+    @staticmethod
+    def __is_closed(mode, end):
+        """end までのデータがもう増えないか (四半期は決算発表を考慮して 2 年度前まで)"""
+        today = date.today()
+        if mode == "quarter":
+            return int(end.split("Q")[0]) <= today.year - 2
+        return end < today.isoformat()
+
+    @staticmethod
+    def num_requests(mode, plan, max_num_year=None):
+        """計画のリクエスト数"""
+        if mode == "indicator":
+            return len(plan)
+        return sum([len(BCAPI.sliced_periods(mode, s, e, max_num_year)) for _, s, e in plan])
+
+    def __trim(self, mode, ticker, start, end):
+        """データがないとわかっている先頭の期間を除いた開始を返す。全期間なければ None"""
+        for es, ee in sorted(self.empty.get(mode, {}).get(str(ticker), [])):
+            if es <= start <= ee:
+                start = BCRequestPlanner.shift(mode, ee, 1)
+        return start if start <= end else None
+
+    def observe(self, mode, ticker, start, end, df):
+        """
+        取得結果からデータがなかった期間を記録する
+
+        Parameters
+        ----------
+        mode : str
+            "quarter" or "daily"
+        ticker : int
+            銘柄コード
+        start : str
+            取得開始
+        end : str
+            取得終了
+        df : pandas.DataFrame
+            取得結果 (データがなければ None)
+        """
+        if df is None or len(df) < 1:
+            # 今後データが増えうる期間は記録しない
+            if not BCRequestPlanner.__is_closed(mode, end):
+                return
+            r = [start, end]
+        else:
+            if mode == "quarter":
+                n = int((df["fiscal_year"] * 4 + df["fiscal_quarter"] - 1).min())
+                first = f"{n // 4}Q{n % 4 + 1}"
+            else:
+                first = str(df["day"].min())
+            if first <= start:
+                return
+            r = [start, BCRequestPlanner.shift(mode, first, -1)]
+        with self.lock:
+            l = self.empty.setdefault(mode, {}).setdefault(str(ticker), [])
+            if r not in l:
+                l.append(r)
+
+    def plan(self, mode, ranges, max_num_company=None, max_num_year=None):
+        """
+        取得計画を立てる
+
+        Parameters
+        ----------
+        mode : str
+            "quarter" or "daily" or "indicator"
+        ranges : dict
+            {銘柄コード: (開始, 終了)}。indicator の場合期間は使わない
+        max_num_company : int
+            1 リクエストで指定できる銘柄数 (省略時は BCAPI.MAX_NUM_COMPANY)
+        max_num_year : int
+            四半期データの 1 リクエストで指定できる年数 (省略時は BCAPI.MAX_NUM_YEAR)
+
+        Returns
+        -------
+        list
+            (銘柄コードのリスト, 開始, 終了) のリスト。BCAPI.get_planned() に渡す
+        """
+        n_max = max_num_company if max_num_company is not None else BCAPI.MAX_NUM_COMPANY
+        items = []
+        for t, (s, e) in ranges.items():
+            if mode != "indicator":
+                s = self.__trim(mode, t, s, e)
+                if s is None:
+                    logger.debug(f"skipped {mode} of {t}: no data in ({ranges[t]})")
+                    continue
+            items.append((s, e, t))
+        items.sort()
+
+        plan = []
+        for s, e, t in items:
+            if len(plan) > 0:
+                ts, ps, pe = plan[-1]
+                if len(ts) < n_max:
+                    if mode == "indicator":
+                        plan[-1] = (ts + [t], ps, pe)
+                        continue
+                    # 開始順に並べてあるので ps <= s。一緒に取ってもリクエスト数が増えないならまとめる
+                    ue = max(pe, e)
+                    if len(BCAPI.sliced_periods(mode, ps, ue, max_num_year)) <= len(BCAPI.sliced_periods(mode, ps, pe, max_num_year)):
+                        plan[-1] = (ts + [t], ps, ue)
+                        continue
+            plan.append(([t], s, e))
+        return plan
+
+class BCBatchTuner:
+    """
+    1 リクエストでまとめる銘柄数・期間 (年数) を endpoint ごとに調整する
+
+    サーバーが受け付ける上限 (limits) は probe() で実際にリクエストを投げて調べ、
+    その範囲内で endpoint ごとの銘柄数 (sizes) をレスポンスの速さ・エラーから増減させる。
+    状態は state_path に保存しておき、次回以降の取得計画に使う。
+
+    Attributes
+    ----------
+    state_path : Path
+        調整結果の保存先。None なら保存しない
+    ceiling : dict
+        probe で試す上限 {"num_company": 銘柄数, "num_year": 年数}
+    limits : dict
+        サーバーが受け付ける上限 {"num_company": 銘柄数, "num_year": 年数}
+    sizes : dict
+        endpoint ごとに実際に使う銘柄数 {endpoint: 銘柄数}
+    """
+
+    # これより遅いレスポンスがあれば銘柄数を減らす [sec]
+    TARGET_LATENCY = 10.0
+    # 速いレスポンスがこの回数続いたら銘柄数を 1 増やす (limits まで)
+    GROW_AFTER = 20
+
+    def __init__(self, state_path=None, max_num_company=50, max_num_year=10):
+        self.state_path = Path(state_path) if state_path is not None else None
+        self.lock = threading.Lock()
+        self.ceiling = {"num_company" : max_num_company, "num_year" : max_num_year}
+        self.limits = {"num_company" : BCAPI.MAX_NUM_COMPANY, "num_year" : BCAPI.MAX_NUM_YEAR}
+        self.sizes = {}
+        self.__good = {} # endpoint ごとの速いレスポンスの連続回数
+        if self.state_path is not None and self.state_path.exists():
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            self.limits.update(state.get("limits", {}))
+            self.sizes.update(state.get("sizes", {}))
+
+    def save(self):
+        if self.state_path is None:
+            return
+        with self.lock:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.state_path, "w") as f:
+                json.dump({"limits" : self.limits, "sizes" : self.sizes}, f, indent=4)
+
+    def num_company(self, endpoint):
+        """endpoint の 1 リクエストでまとめる銘柄数"""
+        with self.lock:
+            n = self.sizes.get(endpoint, self.limits["num_company"])
+            return max(1, min(n, self.limits["num_company"], self.ceiling["num_company"]))
+
+    def num_year(self):
+        """四半期データの 1 リクエストで指定する年数"""
+        with self.lock:
+            return max(1, min(self.limits["num_year"], self.ceiling["num_year"]))
+
+    def observe(self, endpoint, num_tickers, latency, error=None):
+        """
+        レスポンス 1 回分の結果から endpoint の銘柄数を調整する
+
+        Parameters
+        ----------
+        endpoint : str
+        num_tickers : int
+            リクエストした銘柄数
+        latency : float
+            レスポンスにかかった時間 [sec]
+        error : Exception
+            エラーになった場合はその例外
+        """
+        if endpoint == "company" or num_tickers < 1:
+            return
+        with self.lock:
+            limit = self.limits["num_company"]
+            size = self.sizes.get(endpoint, limit)
+            if error is not None:
+                if isinstance(error, BCExceededFetchError):
+                    return
+                if isinstance(error, BCFetchError) and not isinstance(error, (BCServerError, BCMalformedResponseError)):
+                    if "Too many tickers" in str(error) and num_tickers <= limit:
+                        # サーバーの上限が下がった
+                        self.limits["num_company"] = max(1, num_tickers - 1)
+                        logger.warn(f"max number of tickers per request is lowered to {self.limits['num_company']}")
+                    return
+                # タイムアウト・5xx などは重すぎるとみなして半分に
+                size = min(size, max(1, num_tickers // 2))
+                self.__good[endpoint] = 0
+            elif latency > BCBatchTuner.TARGET_LATENCY:
+                size = min(size, max(1, num_tickers - 1))
+                self.__good[endpoint] = 0
+            else:
+                n = self.__good.get(endpoint, 0) + 1
+                if n >= BCBatchTuner.GROW_AFTER and num_tickers >= size:
+                    size += 1
+                    n = 0
+                self.__good[endpoint] = n
+            size = max(1, min(size, self.limits["num_company"]))
+            if size != self.sizes.get(endpoint, limit):
+                logger.info(f"number of tickers per {endpoint} request: {size}")
+            self.sizes[endpoint] = size
+
+    @staticmethod
+    def __accepted(func, *args):
+        """リクエストが受け付けられるか (制限によるエラーなら False)"""
+        try:
+            func(*args)
+            return True
+        except BCExceededFetchError:
+            raise
+        except (BCServerError, BCMalformedResponseError):
+            raise
+        except BCFetchError as e:
+            logger.info(f"rejected: {e}")
+            return False
+
+    @staticmethod
+    def __search(accepted, lo, ceiling):
+        """accepted(n) が True になる最大の n を lo から倍々 + 二分探索で求める"""
+        hi = None
+        n = lo
+        while n < ceiling:
+            n = min(n * 2, ceiling)
+            if accepted(n):
+                lo = n
+            else:
+                hi = n
+                break
+        if hi is None:
+            return lo
+        while hi - lo > 1:
+            m = (lo + hi) // 2
+            if accepted(m):
+                lo = m
+            else:
+                hi = m
+        return lo
+
+    def probe(self, api, tickers):
+        """
+        実際にリクエストを投げて、サーバーが受け付ける銘柄数・年数の上限を調べる
+
+        NOTE: 数リクエスト～十数リクエスト分の quota を消費する
+
+        Parameters
+        ----------
+        api : BCAPI インスタンス
+        tickers : list
+            試しに取得する銘柄コード (上限を調べたい銘柄数以上あること)
+
+        Returns
+        -------
+        dict
+            limits
+        """
+        tickers = list(tickers)
+        ceiling_company = min(self.ceiling["num_company"], len(tickers))
+        num_company = BCBatchTuner.__search(
+            lambda n: BCBatchTuner.__accepted(api.get_indicator_directly, tickers[:n]),
+            1, ceiling_company)
+        # 上限までとれたなら、それ以上は試していないので上限の値を使う
+        this_year = date.today().year
+        num_year = BCBatchTuner.__search(
+            lambda n: BCBatchTuner.__accepted(api.get_quarter_directly, tickers[:1], f"{this_year - n}Q1", f"{this_year - 1}Q4"),
+            1, self.ceiling["num_year"])
+        with self.lock:
+            self.limits = {"num_company" : num_company, "num_year" : num_year}
+            # 調整し直し
+            self.sizes = {}
+            self.__good = {}
+        logger.info(f"probed limits: {num_company} tickers, {num_year} years per request")
+        self.save()
+        return dict(self.limits)
+
+class BCFetchStats:
+    """
+    リクエストごとの計測値 (レイテンシ, サイズ, リトライ回数, limiter の待ち時間など) を記録・集計する
+
+    記録は fetch ジョブ (start_job() ～ end_job()) ごとに集計できる。
+
+    Attributes
+    ----------
+    records : list
+        リクエストごとの記録 (dict)
+        * job : ジョブ名
+        * endpoint : "quarter", "indicator", "daily", "company"
+        * num_tickers : 銘柄数
+        * from, to : 期間
+        * source : "network", "cache", "journal", "coalesced" (他の BCAPI のリクエストの結果を使った),
+                   "unsent" (limiter で quota 切れ・中断となりリクエストを投げなかった) のいずれか
+        * latency : 応答までの時間 [sec]
+        * connect_time : 接続確立にかかった時間 [sec]
+        * bytes : レスポンスのサイズ [byte]
+        * retries : 何回目のリトライか (初回は 0)
+        * wait : limiter で待った時間 [sec]
+        * quota_remaining : リクエスト後の quota 残り (上限なしなら None)
+        * error : エラーの種類 (正常なら None)
+    jobs : dict
+        ジョブ名 -> {"start" : 開始時刻, "end" : 終了時刻}
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.jobs = {}
+        self.current_job = None
+
+    def start_job(self, name):
+        """
+        ジョブを開始する。同名のジョブがすでにあれば "{name}#{通し番号}" にする。
+
+        Returns
+        -------
+        str
+            ジョブ名
+        """
+        with self.lock:
+            n = 1
+            job = name
+            while job in self.jobs:
+                n += 1
+                job = f"{name}#{n}"
+            self.current_job = job
+            self.jobs[job] = {"start" : time.time(), "end" : None}
+            return job
+
+    def end_job(self):
+        with self.lock:
+            if self.current_job is not None:
+                self.jobs[self.current_job]["end"] = time.time()
+            self.current_job = None
+
+    def record(self, **rec):
+        with self.lock:
+            rec["job"] = self.current_job
+            rec["time"] = time.time()
+            self.records.append(rec)
+
+    def summary(self, job=None):
+        """
+        集計値を返す
+
+        Parameters
+        ----------
+        job : str
+            集計対象のジョブ名。None なら全記録
+
+        Returns
+        -------
+        dict
+        """
+        with self.lock:
+            recs = [r for r in self.records if job is None or r["job"] == job]
+            span = self.jobs.get(job)
+        net = [r for r in recs if r["source"] == "network"]
+        latencies = sorted([r["latency"] for r in net])
+        def __percentile(p):
+            if len(latencies) < 1:
+                return None
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+        result = {
+            "job" : job,
+            "num_requests" : len(net),
+            "cache_hits" : len([r for r in recs if r["source"] == "cache"]),
+            "journal_hits" : len([r for r in recs if r["source"] == "journal"]),
+            "coalesced" : len([r for r in recs if r["source"] == "coalesced"]),
+            "unsent" : len([r for r in recs if r["source"] == "unsent"]),
+            "errors" : len([r for r in recs if r["error"] is not None]),
+            # 各記録の retries は何回目のリトライかなので、リトライとして投げたリクエストを数える
+            "retries" : len([r for r in net if r["retries"] > 0]),
+            "bytes" : sum([r["bytes"] for r in net]),
+            "latency_total" : sum(latencies),
+            "latency_p50" : __percentile(0.5),
+            "latency_p95" : __percentile(0.95),
+            "connect_time_total" : sum([r["connect_time"] for r in net]),
+            "wait_total" : sum([r["wait"] for r in net]),
+            "quota_remaining" : net[-1]["quota_remaining"] if len(net) > 0 else None,
+            "elapsed" : None,
+        }
+        if span is not None:
+            result["elapsed"] = (span["end"] if span["end"] is not None else time.time()) - span["start"]
+        return result
+
+    def log_summary(self, job=None):
+        s = self.summary(job)
+        logger.info(f"stats{'' if job is None else f' ({job})'}: {s['num_requests']} requests"
+                    f" (cache: {s['cache_hits']}, journal: {s['journal_hits']}, coalesced: {s['coalesced']}, unsent: {s['unsent']}, errors: {s['errors']}, retries: {s['retries']}),"
+                    f" {s['bytes'] / 1e6:.1f} MB, latency: {s['latency_total']:.1f} sec,"
+                    f" limiter wait: {s['wait_total']:.1f} sec, quota remaining: {s['quota_remaining']}")
+
+    def dump_jsonl(self, path):
+        """全記録を JSON Lines で出力"""
+        with self.lock:
+            recs = list(self.records)
+        with open(path, "w") as f:
+            for r in recs:
+                f.write(json.dumps(r) + "\n")
+
+    def to_prometheus(self):
+        """ジョブ・endpoint ごとの集計を Prometheus の text 形式で返す"""
+        with self.lock:
+            recs = list(self.records)
+        agg = {}
+        for r in recs:
+            k = (r["job"] or "", r["endpoint"], r["source"])
+            a = agg.setdefault(k, {"requests" : 0, "errors" : 0, "latency" : 0.0, "bytes" : 0, "retries" : 0, "wait" : 0.0, "quota" : None})
+            a["requests"] += 1
+            a["errors"] += 0 if r["error"] is None else 1
+            a["latency"] += r["latency"]
+            a["bytes"] += r["bytes"]
+            a["retries"] += 1 if r["retries"] > 0 else 0
+            a["wait"] += r["wait"]
+            if r["quota_remaining"] is not None:
+                a["quota"] = r["quota_remaining"]
+        metrics = [
+            ("bc_api_requests_total", "counter", "requests", "Number of requests"),
+            ("bc_api_errors_total", "counter", "errors", "Number of failed requests"),
+            ("bc_api_latency_seconds_total", "counter", "latency", "Total request latency"),
+            ("bc_api_response_bytes_total", "counter", "bytes", "Total response size"),
+            ("bc_api_retries_total", "counter", "retries", "Number of requests sent as retries"),
+            ("bc_api_limiter_wait_seconds_total", "counter", "wait", "Total time waiting on the rate limiter"),
+            ("bc_api_quota_remaining", "gauge", "quota", "Remaining daily quota"),
+        ]
+        lines = []
+        for name, kind, key, desc in metrics:
+            lines.append(f"# HELP {name} {desc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (job, endpoint, source), a in sorted(agg.items()):
+                if a[key] is None:
+                    continue
+                lines.append(f'{name}{{job="{job}",endpoint="{endpoint}",source="{source}"}} {a[key]}')
+        return "\n".join(lines) + "\n"
+
+    def dump_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
+
+# 接続確立 (TCP + TLS) にかかった時間の計測用。リクエストはスレッドごとに同期実行されるのでスレッドローカルに持つ
+_conn_stats = threading.local()
+
+# __fetch_safe() から __get() にリトライ回数を伝える用
+_request_ctx = threading.local()
+
+def _add_connect_time(t):
+    _conn_stats.connect_time = getattr(_conn_stats, "connect_time", 0.0) + t
+    _conn_stats.num_connect = getattr(_conn_stats, "num_connect", 0) + 1
+
+def _pop_connect_stats():
+    t = getattr(_conn_stats, "connect_time", 0.0)
+    n = getattr(_conn_stats, "num_connect", 0)
+    _conn_stats.connect_time = 0.0
+    _conn_stats.num_connect = 0
+    return t, n
+
+class _BCHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _add_connect_time(time.perf_counter() - start)
+class _BCHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        # NOTE: TLS ハンドシェイクもこの中で行われる
+        start = time.perf_counter()
+        super().connect()
+        _add_connect_time(time.perf_counter() - start)
+class _BCHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _BCHTTPConnection
+class _BCHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _BCHTTPSConnection
+
+class _BCHTTPAdapter(HTTPAdapter):
+    """
+    接続確立時間を計測する connection を使う HTTPAdapter
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http" : _BCHTTPConnectionPool,
+            "https" : _BCHTTPSConnectionPool,
+        }
+
+class _BCColumnBuffer:
+    """
+    取得データ (レコードのリスト) を列ごとのリストに追記していくバッファ
+    """
+    def __init__(self):
+        self.columns = {}
+        self.n = 0
+
+    def append(self, records):
+        if records is None:
+            return
+        for r in records:
+            # 途中から出てきた列は前を None で埋める
+            # NOTE: 列の順番が実行ごとに変わらないようレコードの順番で追加する (set の差だと順番が不定)
+            for k in r.keys():
+                if k not in self.columns:
+                    self.columns[k] = [None] * self.n
+            for k, col in self.columns.items():
+                col.append(r.get(k))
+            self.n += 1
+
+    def to_frame(self):
+        if self.n < 1:
+            return None
+        return pd.DataFrame(self.columns)
+
+class BCRequestCoalescer:
+    """
+    同じリクエスト (endpoint, パラメータ) が同時に投げられようとしたら、
+    最初の 1 つだけ実際に投げて結果を他にも渡す。複数の BCAPI で共有して使う。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.inflight = {}
+
+    def run(self, key, func, stop_event=None):
+        """
+        key のリクエストが実行中ならその結果を待ち、なければ func を実行する
+
+        Parameters
+        ----------
+        key : str
+            リクエストの識別子 (BCResponseCache.key() など)
+        func : function
+            実際にリクエストを投げる関数
+        stop_event : threading.Event
+            待っている間に set されたら BCFetchStopped を投げる (set した側で wake() を呼ぶ)
+
+        Returns
+        -------
+        result
+            func の結果
+        shared : bool
+            他のリクエストの結果を受け取った場合 True
+        """
+        while True:
+            with self.cond:
+                ent = self.inflight.get(key)
+                leader = ent is None
+                if leader:
+                    ent = self.inflight[key] = {"done" : False, "result" : None, "error" : None}
+                    break
+                # 投げた側が終わるか stop されるまで待つ (どちらも notify で起こされる)
+                while not ent["done"]:
+                    if stop_event is not None and stop_event.is_set():
+                        raise BCFetchStopped()
+                    self.cond.wait()
+            # 投げた側が中断しただけなら自分で投げ直す
+            if isinstance(ent["error"], BCFetchStopped):
+                continue
+            if ent["error"] is not None:
+                raise ent["error"]
+            # 呼び出し側で結果を書き換えることがあるので (get_company など) それぞれコピーを渡す
+            return copy.deepcopy(ent["result"]), True
+
+        try:
+            result = func()
+            ent["result"] = copy.deepcopy(result)
+            return result, False
+        except BaseException as e:
+            ent["error"] = e
+            raise
+        finally:
+            with self.cond:
+                del self.inflight[key]
+                ent["done"] = True
+                self.cond.notify_all()
+
+    def wake(self):
+        """run() で待っているものを起こす (stop_event を set した後に呼ぶ)"""
+        with self.cond:
+            self.cond.notify_all()
+
+_PIPE_END = object()
+
+class _BCChannel:
+    """
+    _BCPipeline のステージ間のサイズ制限つきキュー
+
+    close() すると待っている put(), get() がすぐに戻る (待つ間はタイムアウトで起きたりしない)
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        """入れられたら True、close() されていたら False"""
+        with self.cond:
+            while len(self.items) >= self.maxsize and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.items.append(item)
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        """取り出した要素。close() されていたら _PIPE_END"""
+        with self.cond:
+            while len(self.items) < 1 and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return _PIPE_END
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class _BCPipeline:
+    """
+    source → stage1 → stage2 → ... をそれぞれ別スレッドで動かすパイプライン
+
+    ステージ間はサイズ制限つきのキューでつなぐので、後段が詰まれば前段も止まる (backpressure)。
+    各ステージは 1 スレッドで処理するので順序は source の順のまま。
+    最終ステージの出力を呼び出し側で順に取り出す。
+
+    Parameters
+    ----------
+    source : iterable
+        入力 (ネットワーク取得のジェネレータなど)。close() を持っていれば終了時に呼ぶ
+    stages : list
+        各ステージの関数。入力 1 つを受け取り、後段に渡す出力の iterable を返す
+    maxsize : int
+        ステージ間のキューのサイズ
+    """
+    def __init__(self, source, stages, maxsize=8):
+        self.source = source
+        self.stages = stages
+        self.maxsize = maxsize
+
+    def __iter__(self):
+        queues = [_BCChannel(self.maxsize) for _ in range(len(self.stages) + 1)]
+        errors = []
+
+        def stop():
+            # 下流のエラーや途中終了で全体を止める (待っているスレッドはすぐ戻る)
+            for q in queues:
+                q.close()
+
+        def feed():
+            # source のエラーはそこまでの分を後段で処理しきってから呼び出し側に投げる
+            try:
+                for item in self.source:
+                    if not queues[0].put(item):
+                        break
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                if hasattr(self.source, "close"):
+                    self.source.close()
+                queues[0].put(_PIPE_END)
+
+        def work(stage, q_in, q_out):
+            try:
+                while True:
+                    item = q_in.get()
+                    if item is _PIPE_END:
+                        break
+                    for out in stage(item):
+                        if not q_out.put(out):
+                            return
+            except BaseException as e:
+                errors.append(e)
+                stop()
+            finally:
+                q_out.put(_PIPE_END)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True))
+        for th in threads:
+            th.start()
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _PIPE_END:
+                    break
+                yield item
+        finally:
+            stop()
+            for th in threads:
+                th.join()
+        if errors:
+            raise errors[0]
 
 class BCAPI:
     # 取得元
     URL_API = "https://api.buffett-code.com/api/v2/"
 
-    # 取得制限銘柄数・期間
+    # 取得制限銘柄数・期間 (BCBatchTuner を使わない場合の値)
     MAX_NUM_COMPANY = 3
     MAX_NUM_YEAR = 3
 
-    def __init__(self, api_key):
+    # エラーの種類ごとのリトライ方針
+    RETRY_POLICIES = {
+        "network" : BCRetryPolicy(base=5, max_delay=600),                   # 接続エラー・タイムアウト
+        "server" : BCRetryPolicy(base=30, max_delay=1800),                  # 5xx
+        "malformed" : BCRetryPolicy(base=30, max_delay=1800, max_retries=5), # JSON として読めない
+        "api" : BCRetryPolicy(base=60, max_delay=3600, max_retries=10),      # その他 API のエラーメッセージ
+    }
+
+    # 取得 → dataframe 化 → 後処理 (書き込み) のステージ間キューのサイズ
+    PIPELINE_QUEUE_SIZE = 8
+
+    def __init__(self, api_key, pool_size=10, timeout=(10, 60), limiter=None, num_workers=4, cache=None, url_api=None, batch=None,
+                 coalescer=None, priority=0):
+        """
+        Parameters
+        ----------
+        api_key : str
+            API キー
+        pool_size : int
+            keep-alive で使い回す接続の最大数
+        timeout : tuple
+            (接続タイムアウト, 読み込みタイムアウト) [sec]
+        limiter : BCRateLimiter
+            リクエスト制限。省略時は 1 リクエスト/秒、quota なし
+        num_workers : int
+            同時に投げるリクエストの最大数
+        cache : BCResponseCache
+            レスポンスのキャッシュ。None ならキャッシュしない
+        url_api : str
+            取得元の URL。テスト用サーバー (bc_mock.py) などに差し替える場合に指定
+        batch : BCBatchTuner
+            1 リクエストでまとめる銘柄数・年数の調整。None なら MAX_NUM_COMPANY, MAX_NUM_YEAR 固定
+        coalescer : BCRequestCoalescer
+            他の BCAPI と同時に同じリクエストを投げないようにする場合に共有のものを指定
+        priority : int
+            limiter を他の BCAPI と共有する場合の優先度 (大きいほど優先)
+        """
         self.api_key = api_key
-        self.stop_fetch = False # fetch を途中でやめるためのフラグ
+        if url_api is not None:
+            self.URL_API = url_api
+        self.stop_event = threading.Event() # fetch を途中でやめるためのフラグ
+        self.retry_policies = dict(BCAPI.RETRY_POLICIES)
+        self.__aborts = set() # 実行中の並列取得の打ち切り用 event
+        self.__aborts_lock = threading.Lock()
+        self.timeout = timeout
+        self.limiter = limiter if limiter is not None else BCRateLimiter()
+        self.num_workers = num_workers
+        self.cache = cache
+        self.batch = batch
+        self.coalescer = coalescer
+        self.priority = priority
+        self.journal = None # BCFetchJournal。ジョブ実行中のみ設定される
+        self.reserving = False # limiter の quota を確保して取得中か (reserve() 参照)
+        self.stats = BCFetchStats()
+
+        # 全リクエストで共有する keep-alive セッション
+        self.session = requests.Session()
+        self.session.headers.update({
+            "x-api-key" : api_key,
+            "Accept-Encoding" : "gzip, deflate",
+        })
+        pool_size = max(pool_size, num_workers)
+        adapter = _BCHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # 接続確立にかかった時間の累計
+        self.connect_time = 0.0
+        self.num_connect = 0
+
+    @property
+    def stop_fetch(self):
+        return self.stop_event.is_set()
+
+    @stop_fetch.setter
+    def stop_fetch(self, value):
+        if value:
+            self.stop()
+        else:
+            self.stop_event.clear()
+
+    def stop(self):
+        """fetch を中断する。リトライ待ちなどもすぐに打ち切られる"""
+        self.stop_event.set()
+        with self.__aborts_lock:
+            for abort in self.__aborts:
+                abort.set()
+        # limiter, coalescer で待っているものも起こす
+        self.limiter.wake()
+        if self.coalescer is not None:
+            self.coalescer.wake()
+
+    def reserve(self, num_requests):
+        """
+        これから投げるリクエスト数を limiter の quota から確保する (limiter を他の BCAPI と共有する場合用)
 
-    @staticmethod
-    def __get(url, params, headers):
+        release() するまでの間は、quota を使い切ったらリセットを待たずに BCExceededFetchError で取得を打ち切る
+        (残りはジャーナルから次回に再開する)。
+
+        Parameters
+        ----------
+        num_requests : int
+            確保したいリクエスト数
+
+        Returns
+        -------
+        int
+            確保できたリクエスト数。quota 未設定なら None
+        """
+        self.reserving = True
+        return self.limiter.reserve(self, num_requests)
+
+    def release(self):
+        """reserve() で確保して使わなかった分を limiter に返す"""
+        self.reserving = False
+        self.limiter.release(self)
+
+    def num_company(self, endpoint):
+        """endpoint の 1 リクエストでまとめる銘柄数"""
+        if self.batch is None:
+            return self.MAX_NUM_COMPANY
+        return self.batch.num_company(endpoint)
+
+    def num_year(self):
+        """四半期データの 1 リクエストで指定する年数"""
+        if self.batch is None:
+            return self.MAX_NUM_YEAR
+        return self.batch.num_year()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __get(self, endpoint, params):
         """API データ取得用の基本関数
 
         Parameters
         ----------
-        url : str
-            データ取得先 URL
+        endpoint : str
+            データ取得先 ("quarter", "indicator", "daily", "company")
         params : dict
             取得用パラメータ
-        headers : dict
-            取得用ヘッダ
 
         Returns
         -------
@@ -68,18 +1546,118 @@ class BCAPI:
             取得したデータ
         """
 
-        # データ取得
-        # 終わったら負荷をかけないように 1 秒休む
-        d = requests.get(url, params=params, headers=headers).json()
-        time.sleep(1)
-        # エラー時にはメッセージが "message" キーに格納されている
-        if "message" in d:
-            if d["message"] == "Limit Exceeded":
-                raise BCExceededFetchError(f"Fetching Error: {d['message']}")
-            else:
-                raise BCFetchError(f"Fetching Error: {d['message']}")
+        rec = {
+            "endpoint" : endpoint,
+            "num_tickers" : len(params["tickers"].split(",")) if "tickers" in params else 0,
+            "from" : params.get("from"),
+            "to" : params.get("to"),
+            "source" : "network",
+            "latency" : 0.0,
+            "connect_time" : 0.0,
+            "bytes" : 0,
+            "retries" : getattr(_request_ctx, "retries", 0),
+            "wait" : 0.0,
+            "quota_remaining" : None,
+            "error" : None,
+        }
+
+        # ジャーナルに取得済みとして記録されていればそれを使う
+        journal = self.journal
+        if journal is not None:
+            d = journal.get(endpoint, params)
+            if d is not None:
+                logger.debug(f"journal hit! ({endpoint}, {params})")
+                self.stats.record(**{**rec, "source" : "journal"})
+                return d
+        # キャッシュがあればそれを使う
+        if self.cache is not None:
+            d = self.cache.get(endpoint, params)
+            if d is not None:
+                logger.debug(f"cache hit! ({endpoint}, {params})")
+                self.stats.record(**{**rec, "source" : "cache"})
+                return d
+
+        # 他の BCAPI が同じリクエストを投げている最中ならその結果を使う
+        if self.coalescer is not None:
+            led = [] # 自分で投げたか (投げた場合は __request() で記録済み)
+            def _request():
+                led.append(True)
+                return self.__request(endpoint, params, rec)
+            try:
+                d, shared = self.coalescer.run(BCResponseCache.key(endpoint, params), _request, self.stop_event)
+            except BCFetchStopped:
+                raise
+            except Exception as e:
+                if len(led) < 1:
+                    # 他が投げたリクエストのエラーを受け取った
+                    self.stats.record(**{**rec, "source" : "coalesced", "error" : type(e).__name__})
+                raise
+            if shared:
+                logger.debug(f"coalesced! ({endpoint}, {params})")
+                self.stats.record(**{**rec, "source" : "coalesced"})
+        else:
+            d = self.__request(endpoint, params, rec)
+        if journal is not None:
+            journal.put(endpoint, params, d)
+        if self.cache is not None:
+            self.cache.put(endpoint, params, d)
+        return d
+
+    def __request(self, endpoint, params, rec):
+        """実際に API にリクエストを投げる。rec に統計を記録する"""
+        start = None
+        try:
+            # データ取得
+            # 負荷をかけないよう limiter で間隔を調整する
+            rec["wait"] = self.limiter.acquire(self.stop_event, self.priority, self)
+            _pop_connect_stats()
+            start = time.perf_counter()
+            r = self.session.get(urljoin(self.URL_API, endpoint), params=params, timeout=self.timeout)
+            rec["bytes"] = len(r.content)
+            if r.status_code >= 500:
+                raise BCServerError(f"Server Error: {r.status_code} {r.reason}")
+            try:
+                d = r.json()
+            except ValueError as e:
+                raise BCMalformedResponseError(f"Malformed response: {e}")
+            rec["latency"] = time.perf_counter() - start
+            connect_time, num_connect = _pop_connect_stats()
+            rec["connect_time"] = connect_time
+            self.connect_time += connect_time
+            self.num_connect += num_connect
+            logger.debug(f"elapsed: {rec['latency']:.3f} sec, connection setup: {connect_time:.3f} sec ({num_connect} new connection(s))")
+            # エラー時にはメッセージが "message" キーに格納されている
+            if "message" in d:
+                if d["message"] == "Limit Exceeded":
+                    raise BCExceededFetchError(f"Fetching Error: {d['message']}", self.limiter.exceeded())
+                else:
+                    raise BCFetchError(f"Fetching Error: {d['message']}")
+        except Exception as e:
+            rec["error"] = type(e).__name__
+            # リクエストを投げる前のエラー (quota 切れ・中断) はまとめる銘柄数とは関係ない
+            if self.batch is not None and start is not None:
+                self.batch.observe(endpoint, rec["num_tickers"], time.perf_counter() - start, e)
+            raise
+        finally:
+            rec["quota_remaining"] = self.limiter.remaining()
+            if start is None:
+                # limiter で止まってリクエストは投げていない
+                rec["source"] = "unsent"
+            self.stats.record(**rec)
+        if self.batch is not None:
+            self.batch.observe(endpoint, rec["num_tickers"], rec["latency"])
         return d
 
+    @staticmethod
+    def request_params(tickers, start=None, end=None):
+        """get_xxx_directly() で API に渡すパラメータ"""
+        params = {"tickers" : ",".join(map(str, tickers))}
+        if start is not None:
+            params["from"] = start
+        if end is not None:
+            params["to"] = end
+        return params
+
     def get_quarter_directly(self, tickers, start, end):
         """引数をそのまま渡す四半期データ取得用関数
 
@@ -98,13 +1676,10 @@ class BCAPI:
             取得したデータ
         """
 
-        url =  urljoin(self.URL_API, "quarter")
-        ticker_str = ",".join(map(str, tickers))
-        params =  {"tickers" : ticker_str, "from" : start, "to" : end}
-        headers = {"x-api-key" : self.api_key}
+        params = BCAPI.request_params(tickers, start, end)
 
         logger.info(f"getting quarter data (tickers: {tickers}, start: {start}, end: {end}) ...")
-        return BCAPI.__get(url, params, headers)
+        return self.__get("quarter", params)
 
     def get_indicator_directly(self, tickers):
         """引数をそのまま渡す指標データ取得用関数
@@ -120,13 +1695,10 @@ class BCAPI:
             取得したデータ
         """
 
-        url =  urljoin(self.URL_API, "indicator")
-        ticker_str = ",".join(map(str, tickers))
-        params =  {"tickers" : ticker_str}
-        headers = {"x-api-key" : self.api_key}
+        params = BCAPI.request_params(tickers)
 
         logger.info(f"getting indicator data (tickers: {tickers}) ...")
-        return BCAPI.__get(url, params, headers)
+        return self.__get("indicator", params)
 
     def get_daily_directly(self, tickers, start, end):
         """引数をそのまま渡す daily データ取得用関数
@@ -146,13 +1718,10 @@ class BCAPI:
             取得したデータ
         """
 
-        url =  urljoin(self.URL_API, "daily")
-        ticker_str = ",".join(map(str, tickers))
-        params =  {"tickers" : ticker_str, "from" : start, "to" : end}
-        headers = {"x-api-key" : self.api_key}
+        params = BCAPI.request_params(tickers, start, end)
 
         logger.info(f"getting daily data (tickers: {tickers}, start: {start}, end: {end}) ...")
-        return BCAPI.__get(url, params, headers)
+        return self.__get("daily", params)
 
     def get_company_directly(self):
         """会社データ取得用関数
@@ -163,67 +1732,148 @@ class BCAPI:
             取得したデータ
         """
 
-        url =  urljoin(self.URL_API, "company")
         params =  {}
-        headers = {"x-api-key" : self.api_key}
 
         logger.info(f"getting company data ...")
-        return BCAPI.__get(url, params, headers)
+        return self.__get("company", params)
 
-    def __fetch_safe(self, retry, func, *args, **kwargs):
+    @staticmethod
+    def __error_class(e):
+        """リトライ方針を決めるためのエラーの種類。リトライしないエラーなら None"""
+        if isinstance(e, requests.RequestException):
+            return "network"
+        if isinstance(e, BCServerError):
+            return "server"
+        if isinstance(e, BCMalformedResponseError):
+            return "malformed"
+        if isinstance(e, BCFetchError):
+            return "api"
+        return None
+
+    def __fetch_safe(self, retry, func, *args, abort=None, **kwargs):
         """retry を行いつつ指定関数を実行しデータを取得
 
+        リトライ待ち時間はエラーの種類ごとの方針 (self.retry_policies) で指数的に伸ばす。
+        プログラムのエラーなど API 取得と関係ないエラーはリトライしない。
+
         Parameters
         ----------
         retry : int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]。0 なら方針どおり。
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係な 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
+            reserve() している場合は待たずに BCExceededFetchError を投げる。
         func : function
             実行関数
+        abort : threading.Event
+            set されたら stop フラグと同様に中断する (並列取得の打ち切り用)
 
         Returns
         -------
         dict
             取得したデータ
         """
-        retry_time = datetime(1,1,1,0,0,0,000000) # 適当に小さい値に初期化
-        d = None
+        # 待ちは event で行い、stop されたらすぐ起きる
+        event = abort if abort is not None else self.stop_event
+        retries = {} # エラーの種類ごとのリトライ回数
+        n = 0
 
-        while not self.stop_fetch:
-            if datetime.now() < retry_time:
-                time.sleep(1)
-                continue
+        while not (self.stop_fetch or event.is_set()):
             try:
-                d = func(*args, **kwargs)
+                _request_ctx.retries = n
+                return func(*args, **kwargs)
             except BCExceededFetchError as e:
-                # 24時間休んで retry
+                # 確保した quota を使い切ったら待たずに打ち切る (呼び出し側で次回に回す)
+                if self.reserving:
+                    raise
+                # quota がリセットされるまで (不明なら 24時間) 休んで retry
                 logger.warn(e)
-                logger.warn(f"Wait for 1 day...")
-                retry_time = datetime.now() + timedelta(days=1)
-                continue
-            except:
-                if retry < 0:
+                retry_time = e.retry_at if e.retry_at is not None else datetime.now() + timedelta(days=1)
+                logger.warn(f"Wait until {retry_time:%Y-%m-%d %H:%M:%S} ...")
+                wait = (retry_time - datetime.now()).total_seconds()
+            except Exception as e:
+                cls = BCAPI.__error_class(e)
+                if cls is None or retry < 0:
                     raise
-                else:
-                    logger.error(traceback.print_exc())
-                    logger.error(f"Wait for {retry} minutes...")
-                    retry_time = datetime.now() + timedelta(seconds=retry*60)
-                    continue
-            break
-        else:
-            # stop フラグが設定された
-            raise BCFetchStopped()
-        return d
+                policy = self.retry_policies[cls]
+                k = retries.get(cls, 0)
+                if policy.max_retries is not None and k >= policy.max_retries:
+                    raise
+                retries[cls] = k + 1
+                wait = policy.delay(k)
+                if retry > 0:
+                    wait = min(wait, retry * 60)
+                logger.warn(f"{e} ({cls} error)")
+                logger.warn(f"Wait for {wait:.1f} seconds...")
+            n += 1
+            event.wait(max(wait, 0))
+
+        # stop フラグが設定された
+        raise BCFetchStopped()
+
+    def __fetch_chunks(self, retry, func, chunks):
+        """
+        chunks の各要素を引数に func を並列実行し、chunks の順番で結果を返す。
+        同時に実行中のリクエストは最大 self.num_workers 個 (間隔は self.limiter で制御)。
+
+        Parameters
+        ----------
+        retry : int
+            __fetch_safe() に渡すリトライ待ち時間の上限 [minites]
+        func : function
+            実行関数
+        chunks : list
+            func に渡す引数の tuple のリスト
+
+        Yields
+        -------
+        int
+            chunks のインデックス
+        dict
+            取得したデータ
+        """
+        abort = threading.Event()
+        with self.__aborts_lock:
+            self.__aborts.add(abort)
+        if self.stop_fetch:
+            abort.set()
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        pending = deque()
+        try:
+            for n, args in enumerate(chunks):
+                pending.append((n, executor.submit(self.__fetch_safe, retry, func, *args, abort=abort)))
+                if len(pending) >= self.num_workers:
+                    n_done, f = pending.popleft()
+                    yield n_done, f.result()
+            while len(pending) > 0:
+                n_done, f = pending.popleft()
+                yield n_done, f.result()
+        finally:
+            # 途中で抜けた場合は未実行のものを取り消し、実行中のものも打ち切る
+            abort.set()
+            for _, f in pending:
+                f.cancel()
+            executor.shutdown(wait=True)
+            with self.__aborts_lock:
+                self.__aborts.discard(abort)
+
+    def __log_forecast(self, num_requests):
+        """リクエスト回数から終了・quota 枯渇の見込みをログ出力"""
+        finish, exhausted = self.limiter.forecast(num_requests, self)
+        logger.info(f"{num_requests} requests will be sent (estimated finish: {finish:%Y-%m-%d %H:%M:%S})")
+        if exhausted is not None:
+            logger.warn(f"daily quota will be used up at {exhausted:%Y-%m-%d %H:%M:%S} (remaining: {self.limiter.remaining()})")
 
     @staticmethod
-    def __sliced_tickers_generator(tickers):
+    def __sliced_tickers_generator(tickers, n=None):
         """ 一度の fetch で指定できる企業数(3つ) に制限があるので小分け
 
         Parameters
         ----------
         tickers : list
             銘柄コード
+        n : int
+            1 回の fetch で指定する銘柄数 (省略時は MAX_NUM_COMPANY)
 
         Yields
         -------
@@ -231,13 +1881,14 @@ class BCAPI:
             小分けされた銘柄コード
         """
 
-        for i in range(math.ceil(len(tickers) / BCAPI.MAX_NUM_COMPANY)):
-            j = i * BCAPI.MAX_NUM_COMPANY
-            ts = tickers[j:j+BCAPI.MAX_NUM_COMPANY]
+        n = n if n is not None else BCAPI.MAX_NUM_COMPANY
+        for i in range(math.ceil(len(tickers) / n)):
+            j = i * n
+            ts = tickers[j:j+n]
             yield ts
 
     @staticmethod
-    def __sliced_quarters_generator(start, end):
+    def __sliced_quarters_generator(start, end, max_num_year=None):
         """ 一度の fetch で指定できる期間（3年）に制限があるので小分け
         Parameters
         ----------
@@ -270,14 +1921,15 @@ class BCAPI:
                 q = quarter - 1
             return [y, q]
 
-        # self.MAX_NUM_YEAR ごとに小分け
+        # max_num_year (省略時は MAX_NUM_YEAR) ごとに小分け
+        n = max_num_year if max_num_year is not None else BCAPI.MAX_NUM_YEAR
         sy, sq = [int(s) for s in start.split("Q")]
         ey, eq = orig_ey, orig_eq= [int(s) for s in end.split("Q")]
         while True:
             dy = ey - sy
             dq = eq - sq
-            if dy > BCAPI.MAX_NUM_YEAR or (dy == BCAPI.MAX_NUM_YEAR and dq >= 0):
-                ey_tmp, eq_tmp = __prev_q(sy + BCAPI.MAX_NUM_YEAR, sq)
+            if dy > n or (dy == n and dq >= 0):
+                ey_tmp, eq_tmp = __prev_q(sy + n, sq)
                 yield [f"{sy}Q{sq}", f"{ey_tmp}Q{eq_tmp}"]
                 sy, sq = __next_q(ey_tmp, eq_tmp)
             else:
@@ -311,6 +1963,175 @@ class BCAPI:
             yield [s.isoformat(), (s1 - timedelta(days=1)).isoformat()]
             s = s1
 
+    @staticmethod
+    def sliced_periods(mode, start, end, max_num_year=None):
+        """
+        一度の fetch で指定できる期間に小分けした期間のリスト
+
+        Parameters
+        ----------
+        mode : str
+            "quarter" or "daily"
+        start : str
+            開始四半期 (ex. "2012Q1") または開始日 (ex. "2017-01-01")
+        end : str
+            終了四半期 (ex. "2015Q4") または終了日 (ex. "2019-12-31")
+        max_num_year : int
+            四半期データの 1 リクエストで指定できる年数 (省略時は MAX_NUM_YEAR)
+
+        Returns
+        -------
+        list
+            小分けされた期間 (ex. [["2012Q1", "2014Q4"], ["2015Q1", "2015Q4"]])
+        """
+        if mode == "quarter":
+            return list(BCAPI.__sliced_quarters_generator(start, end, max_num_year))
+        elif mode == "daily":
+            return list(BCAPI.__sliced_daily_generator(start, end))
+        raise RuntimeError(f"invalid mode {mode}")
+
+    @staticmethod
+    def drop_duplicated(df, keys):
+        """
+        keys が重複している行は後のものを残して削除し、keys で sort する
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        keys : list
+            重複判定・sort に使う列名
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        df = df.set_index(keys)
+        df = df[~df.index.duplicated(keep="last")]
+        df = df.sort_index()
+        return df.reset_index()
+
+    @staticmethod
+    def __to_frame(mode, ticker, buf):
+        """列ごとのバッファ (1 銘柄・全期間分) を dataframe 化。データがなければ None"""
+        df = buf.to_frame()
+        if df is None:
+            return None
+        df.insert(0, "ticker", ticker)
+        if mode == "quarter":
+            # NOTE: 四半期データで重複している場合があった。どれが正しいかは不明・・・だがとりあえず重複を削除する
+            return BCAPI.drop_duplicated(df, ["ticker", "fiscal_year", "fiscal_quarter"])
+        df["day"] = pd.to_datetime(df["day"]).dt.strftime("%Y-%m-%d")
+        return BCAPI.drop_duplicated(df, ["ticker", "day"])
+
+    def planned_requests(self, mode, plan):
+        """
+        取得計画を実行した場合に投げるリクエスト (get_planned(), get_indicator() と同じ小分け)
+
+        Parameters
+        ----------
+        mode : str
+            "quarter" or "daily" or "indicator"
+        plan : list
+            (銘柄コードのリスト, 開始, 終了) のリスト。BCRequestPlanner.plan() の結果など。
+
+        Returns
+        -------
+        list
+            (endpoint, パラメータ) のリスト
+        """
+        if mode == "indicator":
+            tickers = [t for ts, _, _ in plan for t in ts]
+            return [("indicator", BCAPI.request_params(ts))
+                    for ts in BCAPI.__sliced_tickers_generator(tickers, self.num_company("indicator"))]
+        return [(mode, BCAPI.request_params(ts, p[0], p[1]))
+                for ts, start, end in plan for p in BCAPI.sliced_periods(mode, start, end, self.num_year())]
+
+    def get_planned(self, mode, plan, func=None, retry=-1):
+        """
+        銘柄グループごとに期間を指定して四半期データ または daily データを取得
+
+        Parameters
+        ----------
+        mode : str
+            "quarter" or "daily"
+        plan : list
+            (銘柄コードのリスト, 開始, 終了) のリスト。BCRequestPlanner.plan() の結果など。
+            銘柄コードのリストは self.num_company(mode) 個以下であること。
+        func : function
+            取得データに対して逐次実行する後処理
+        retry :  int
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
+            負数ならリトライしない。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
+
+        Returns
+        -------
+        list
+            取得したデータ(要素は pandas.DataFrame)
+        """
+
+        if mode == "quarter":
+            getter = self.get_quarter_directly
+        elif mode == "daily":
+            getter = self.get_daily_directly
+        else:
+            raise RuntimeError(f"invalid mode {mode}")
+
+        # 期間を小分けしつつ並列に取得し、plan の順に処理
+        chunks = []
+        is_first = []
+        is_last = []
+        for ts, start, end in plan:
+            periods = BCAPI.sliced_periods(mode, start, end, self.num_year())
+            for i, p in enumerate(periods):
+                chunks.append((ts, p[0], p[1]))
+                is_first.append(i < 1)
+                is_last.append(i == len(periods) - 1)
+        self.__log_forecast(len(chunks))
+
+        # 取得 (並列)、dataframe 化、func (書き込みなど) をそれぞれ別スレッドで流し、
+        # ネットワーク待ちの裏で変換・書き込みを進める
+        col_dict = None
+        bufs = None
+
+        def transform(item):
+            nonlocal col_dict, bufs
+            n, d = item
+            ts = chunks[n][0]
+
+            # 列定義
+            if col_dict is None:
+                col_dict = d["column_description"]
+            elif col_dict != d["column_description"]:
+                # ありえる？一応エラーにしておく
+                raise RuntimeError(f"column definition is not unique!!")
+            # 各期間の結果は列ごとのバッファに追記していき、全期間そろったら一度だけ dataframe 化
+            if is_first[n]:
+                bufs = [_BCColumnBuffer() for _ in ts]
+            for t, buf in zip(ts, bufs):
+                buf.append(d[str(t)])
+            if not is_last[n]:
+                return []
+            return [(ts, [BCAPI.__to_frame(mode, t, buf) for t, buf in zip(ts, bufs)])]
+
+        def persist(item):
+            # func が指定されていればここで各 df に対して実行。
+            ts, dfs = item
+            if func is not None:
+                for t, df in zip(ts, dfs):
+                    func(t, df, col_dict)
+            return [dfs]
+
+        results = []
+        pipeline = _BCPipeline(self.__fetch_chunks(retry, getter, chunks), [transform, persist], maxsize=self.PIPELINE_QUEUE_SIZE)
+        try:
+            for dfs in pipeline:
+                results += dfs
+        except BCFetchStopped:
+            pass
+
+        return results, col_dict
+
     def get_quarter(self, tickers, start, end, func=None, retry=-1):
         """諸々の調整をしつつ四半期財務データを取得
 
@@ -328,9 +2149,9 @@ class BCAPI:
             取得データに対して逐次実行する後処理
             多数取得する場合は何らかの要因で中断しがちなので func で逐次処理できるようにしてある。
         retry :  int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係なく 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
 
         Returns
         -------
@@ -338,59 +2159,9 @@ class BCAPI:
             取得した四半期データ(要素は pandas.DataFrame)
         """
 
-        # ticker を小分けしつつ実行
-        results = []
-        col_dict = None
-        try:
-            for ts in BCAPI.__sliced_tickers_generator(tickers):
-                # 期間を小分けしつつ実行
-                results_ts = []
-                for i, p in enumerate(BCAPI.__sliced_quarters_generator(start, end)):
-                    # 取得
-                    d = self.__fetch_safe(retry, self.get_quarter_directly, ts, p[0], p[1])
-
-                    # 列定義
-                    if col_dict is None:
-                        col_dict = d["column_description"]
-                    elif col_dict != d["column_description"]:
-                        # ありえる？一応エラーにしておく
-                        raise RuntimeError(f"column definition is not unique!!")
-                    # dataframe 化
-                    dfs = []
-                    for t in ts:
-                        l = d[str(t)]
-                        if l is None or len(l) < 1:
-                            dfs.append(None)
-                            continue
-                        df = pd.DataFrame(l)
-                        df["ticker"] = t
-                        df.set_index(["ticker", "fiscal_year", "fiscal_quarter"], inplace=True)
-                        df.sort_index(inplace=True)
-                        # NOTE: 四半期データで重複している場合があった。どれが正しいかは不明・・・だがとりあえず重複を削除する
-                        df = df[~df.index.duplicated(keep="last")]
-                        df.reset_index(inplace=True)
-
-                        dfs.append(df)
-
-                    # 各期間の結果を結合
-                    if i < 1:
-                        results_ts = dfs
-                        continue
-                    for j, df in enumerate(dfs):
-                        if results_ts[j] is None:
-                            results_ts[j] = df
-                        elif df is not None:
-                            results_ts[j] = pd.concat([results_ts[j], df])
-
-                # func が指定されていればここで各 df に対して実行。
-                if func is not None:
-                    for j, df in enumerate(results_ts):
-                        func(ts[j], df, col_dict)
-                results += results_ts
-        except BCFetchStopped:
-            pass
-
-        return results, col_dict
+        # ticker を小分けして取得
+        plan = [(ts, start, end) for ts in BCAPI.__sliced_tickers_generator(tickers, self.num_company("quarter"))]
+        return self.get_planned("quarter", plan, func, retry)
 
     def get_indicator(self, tickers, func=None, retry=-1):
         """諸々の調整をしつつ指標データを取得
@@ -403,41 +2174,53 @@ class BCAPI:
             取得データに対して逐次実行する後処理
             多数取得する場合は何らかの要因で中断しがちなので func で逐次処理できるようにしてある。
         retry :  int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係なく 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
 
         Returns
         -------
         list
             取得した四半期データ(要素は pandas.DataFrame)
         """
-        # ticker を小分けしつつ実行
-        results = []
+        # ticker を小分けしつつ並列に取得し、ticker グループ順に dataframe 化・後処理
         col_dict = None
+        chunks = [(ts,) for ts in BCAPI.__sliced_tickers_generator(tickers, self.num_company("indicator"))]
+        self.__log_forecast(len(chunks))
+
+        def transform(item):
+            nonlocal col_dict
+            n, d = item
+            ts = chunks[n][0]
+            # 列定義
+            if col_dict is None:
+                col_dict = d["column_description"]
+            elif col_dict != d["column_description"]:
+                # ありえる？一応エラーにしておく
+                raise RuntimeError(f"column definition is not uniq!!")
+            # dataframe 化
+            dfs = []
+            for t in ts:
+                l = d[str(t)]
+                if l is None or len(l) < 1:
+                    dfs.append(None)
+                    continue
+                df = pd.DataFrame({"ticker" : t, **l[0]}, index=[0])
+                dfs.append(df)
+            return [(ts, dfs)]
+
+        def persist(item):
+            # func が指定されていればここで各 df に対して実行。
+            ts, dfs = item
+            if func is not None:
+                for t, df in zip(ts, dfs):
+                    func(t, df, col_dict)
+            return [dfs]
+
+        results = []
+        pipeline = _BCPipeline(self.__fetch_chunks(retry, self.get_indicator_directly, chunks), [transform, persist], maxsize=self.PIPELINE_QUEUE_SIZE)
         try:
-            for ts in BCAPI.__sliced_tickers_generator(tickers):
-                # 取得
-                d = self.__fetch_safe(retry, self.get_indicator_directly, ts)
-                # 列定義
-                if col_dict is None:
-                    col_dict = d["column_description"]
-                elif col_dict != d["column_description"]:
-                    # ありえる？一応エラーにしておく
-                    raise RuntimeError(f"column definition is not uniq!!")
-                # dataframe 化
-                dfs = []
-                for t in ts:
-                    l = d[str(t)]
-                    if l is None or len(l) < 1:
-                        dfs.append(None)
-                        continue
-                    df = pd.DataFrame({"ticker" : t, **l[0]}, index=[0])
-                    dfs.append(df)
-                # func が指定されていればここで各 df に対して実行。
-                if func is not None:
-                    for i, df in enumerate(dfs):
-                        func(ts[i], df, col_dict)
+            for dfs in pipeline:
                 results.extend(dfs)
         except BCFetchStopped:
             pass
@@ -459,9 +2242,9 @@ class BCAPI:
             取得データに対して逐次実行する後処理
             多数取得する場合は何らかの要因で中断しがちなので func で逐次処理できるようにしてある。
         retry :  int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係なく 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
 
         Returns
         -------
@@ -469,58 +2252,9 @@ class BCAPI:
             取得した daily データ(要素は pandas.DataFrame)
         """
 
-        # ticker を小分けしつつ実行
-        results = []
-        col_dict = None
-        try:
-            for ts in BCAPI.__sliced_tickers_generator(tickers):
-                # 期間を小分けしつつ実行
-                results_ts = []
-                for i, p in enumerate(BCAPI.__sliced_daily_generator(start, end)):
-                    # 取得
-                    d = self.__fetch_safe(retry, self.get_daily_directly, ts, p[0], p[1])
-
-                    # 列定義
-                    if col_dict is None:
-                        col_dict = d["column_description"]
-                    elif col_dict != d["column_description"]:
-                        # ありえる？一応エラーにしておく
-                        raise RuntimeError(f"column definition is not unique!!")
-                    # dataframe 化
-                    dfs = []
-                    for t in ts:
-                        l = d[str(t)]
-                        if l is None or len(l) < 1:
-                            dfs.append(None)
-                            continue
-                        df = pd.DataFrame(l)
-                        df["ticker"] = t
-                        df["day"] = [d.date().isoformat() for d in pd.to_datetime(df["day"])]
-                        df.set_index(["ticker", "day"], inplace=True)
-                        df.sort_index(inplace=True)
-                        df.reset_index(inplace=True)
-
-                        dfs.append(df)
-
-                    # 各期間の結果を結合
-                    if i < 1:
-                        results_ts = dfs
-                        continue
-                    for j, df in enumerate(dfs):
-                        if results_ts[j] is None:
-                            results_ts[j] = df
-                        elif df is not None:
-                            results_ts[j] = pd.concat([results_ts[j], df])
-
-                # func が指定されていればここで各 df に対して実行。
-                if func is not None:
-                    for j, df in enumerate(results_ts):
-                        func(ts[j], df, col_dict)
-                results += results_ts
-        except BCFetchStopped:
-            pass
-
-        return results, col_dict
+        # ticker を小分けして取得
+        plan = [(ts, start, end) for ts in BCAPI.__sliced_tickers_generator(tickers, self.num_company("daily"))]
+        return self.get_planned("daily", plan, func, retry)
 
     def get_company(self, retry=-1):
         """会社データを取得
@@ -528,9 +2262,9 @@ class BCAPI:
         Parameters
         ----------
         retry :  int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係なく 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
 
         Returns
         -------
@@ -20,14 +20,19 @@ bc_data.py
 
 from pathlib import Path
 import pickle
+import hashlib
+import shutil
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backend_bases import MouseButton
-import webbrowser
 import json
 import re
 from abc import ABCMeta, abstractmethod
+from collections.abc import Mapping
 import time
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
 logger = logging.getLogger(__name__)
 
@@ -51,26 +56,110 @@ class BCDataCompany():
     def tickers(self):
         return list(self.data["ticker"])
 
+    @staticmethod
+    def diff(old, new):
+        """
+        会社一覧の差分を求める
+
+        Parameters
+        ----------
+        old : pd.DataFrame
+            前回の company データ
+        new : pd.DataFrame
+            今回の company データ
+
+        Returns
+        -------
+        dict
+            added : list
+                新たに加わった (新規上場などの) 銘柄コード
+            removed : list
+                なくなった (上場廃止などの) 銘柄コード
+            changed : dict
+                {銘柄コード : 値が変わった列名のリスト} (業種の変更など)
+        """
+        old = old.drop_duplicates("ticker").set_index("ticker")
+        new = new.drop_duplicates("ticker").set_index("ticker")
+        added = sorted(set(new.index) - set(old.index))
+        removed = sorted(set(old.index) - set(new.index))
+        common = sorted(set(old.index) & set(new.index))
+        columns = [c for c in new.columns if c in old.columns]
+        a = old.loc[common, columns]
+        b = new.loc[common, columns]
+        ne = ~((a == b) | (a.isna() & b.isna()))
+        changed = {int(t) : [c for c in columns if ne.at[t, c]] for t in ne.index[ne.any(axis=1)]}
+        return {"added" : [int(t) for t in added], "removed" : [int(t) for t in removed], "changed" : changed}
+
     def ticker2name(self, ticker):
         return self.data.loc[self.data["ticker"] == int(ticker)]["company_name_en"].to_list()[0]
 
+class _BCTickerFrames(Mapping):
+    """
+    全銘柄を連結した dataframe を、銘柄ごとの dataframe の dict のように扱うビュー
+
+    銘柄の行範囲を最初に求めておき、銘柄の dataframe はその範囲をスライスして返す。
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        tickers, starts = np.unique(frame.index.get_level_values("ticker"), return_index=True)
+        ends = list(starts[1:]) + [len(frame)]
+        self.ranges = {str(t) : (s, e) for t, s, e in zip(tickers, starts, ends)}
+
+    def __getitem__(self, ticker):
+        s, e = self.ranges[str(ticker)]
+        return self.frame.iloc[s:e].reset_index()
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
 class BCDataAbs(metaclass=ABCMeta):
     """
     データ要素 (indicator, quarter, daily) の抽象基底クラス
 
     Attributes
     ----------
-    data : dictionary
-        ticker が key, pd.DataFrame が value
+    frame : pd.DataFrame
+        全銘柄を連結したデータ。index は (ticker, 期間の列) で、銘柄順・期間順に並ぶ
+    data : Mapping
+        ticker (str) が key, pd.DataFrame が value (frame の銘柄ごとのビュー)
     dic : dicionary
         列名定義辞書
     """
 
+    # 期間を表す列
+    PERIOD_KEYS = []
+
     @abstractmethod
     def __init__(self, data, dic):
-        self.data = data
+        """
+        Parameters
+        ----------
+        data : pd.DataFrame or dict
+            全銘柄を連結した dataframe (BCDataStore.read_frame())、または {ticker : pd.DataFrame}
+        dic : dictionary
+            列名定義辞書
+        """
+        self.frame = self.index_frame(data)
+        self.data = _BCTickerFrames(self.frame)
         self.dic = dic
 
+    def index_frame(self, data):
+        """全銘柄を連結した dataframe (または {ticker : pd.DataFrame}) を (ticker, 期間の列) の index にする"""
+        if isinstance(data, dict):
+            data = BCDataStore.concat([data[k] for k in sorted(data.keys(), key=int)])
+        for k in self.PERIOD_KEYS:
+            if k not in data.columns:
+                # データがない場合
+                data[k] = pd.Series([], dtype=object)
+        frame = data.set_index(["ticker"] + self.PERIOD_KEYS)
+        if not frame.index.is_monotonic_increasing:
+            frame = frame.sort_index(kind="mergesort")
+        return frame
+
     @abstractmethod
     def get_values(self, query):
         """
@@ -94,23 +183,100 @@ class BCDataAbs(metaclass=ABCMeta):
             result[str(t)] = self.data[str(t)]
         return result
 
+    # CSV を読み込むプロセス数 (None なら CPU 数)
+    NUM_INGEST_WORKERS = None
+    # これより少ない CSV はプロセスを使わずに読む
+    # (spawn で起動したプロセスは pandas の import からやり直すので、起動に数秒かかる)
+    MIN_PARALLEL_FILES = 500
+
     @staticmethod
-    def csvs_to_pickle(outdir):
+    def read_csvs(paths, num_workers=None):
         """
-        指定ディレクトリ以下の CSV ファイルをまとめた pickle ファイルを出力する。
+        CSV をプロセスプールで並列に読み込む
+
+        Parameters
+        ----------
+        paths : list
+            CSV のパス
+        num_workers : int
+            プロセス数。None なら NUM_INGEST_WORKERS
+
+        Returns
+        -------
+        dfs : dict
+            {銘柄コード (str) : pandas.DataFrame} (paths の順)
+        errors : dict
+            {銘柄コード (str) : 読めなかった理由} ("missing", "empty" またはエラー内容)
         """
-        outpath = f"{outdir}/all.pickle"
-        logger.info(f"converting '{outdir}/*.csv' to '{outpath}' ...")
-        dfs = {}
-        for p in sorted(list(Path(outdir).glob("*.csv"))):
+        paths = [Path(p) for p in paths]
+        n = num_workers if num_workers is not None else BCDataAbs.NUM_INGEST_WORKERS
+        n = n if n is not None else (os.cpu_count() or 1)
+        results = None
+        if n > 1 and len(paths) >= BCDataAbs.MIN_PARALLEL_FILES:
             try:
-                dfs[p.stem] = pd.read_csv(p)
-            except pd.errors.EmptyDataError:
-                # 原因は見てないが empty な CSV が生成される場合がある
-                # ex) quarter の 5142.csv
-                continue
-        with open(outpath, mode = "wb") as f:
-            pickle.dump(dfs, f)
+                # fetch はスレッド (GUI・スケジューラー) から呼ばれるので fork はしない
+                with ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    results = list(executor.map(_ingest_csv, paths, chunksize=max(1, len(paths) // (n * 4))))
+            except (OSError, BrokenProcessPool) as e:
+                # プロセスを作れない環境ではそのまま読む
+                logger.warn(f"could not read CSVs in parallel ({e})")
+        if results is None:
+            results = [_ingest_csv(p) for p in paths]
+        dfs = {t : df for t, df, _ in results if df is not None}
+        errors = {t : e for t, _, e in results if e is not None}
+        return dfs, errors
+
+    @staticmethod
+    def csvs_to_store(outdir, mode, changed=None, num_workers=None):
+        """
+        指定ディレクトリ以下の CSV ファイルをまとめたストア (BCDataStore) を出力する。
+
+        空の CSV はデータなしとして除き、読めない (壊れた) CSV はログに出してストアの元のデータを残す。
+
+        Parameters
+        ----------
+        outdir : str or Path
+            CSV のあるディレクトリ
+        mode : str
+            "quarter" or "indicator" or "daily"
+        changed : list
+            内容が変わった銘柄コード。指定されストアが既にあれば、その銘柄の CSV だけ読み直してストアを更新する
+            (空なら何もしない)。None なら全 CSV から作り直す。
+        num_workers : int
+            CSV を読み込むプロセス数。None なら NUM_INGEST_WORKERS
+
+        Returns
+        -------
+        bool
+            ストアを書き出したら True
+        """
+        store = BCDataStore.open(outdir, mode)
+        incremental = changed is not None and store.exists()
+        if incremental:
+            if len(changed) < 1:
+                logger.info(f"'{outdir}' store is up to date")
+                return False
+            logger.info(f"updating {len(changed)} tickers in '{outdir}' store ...")
+            paths = [Path(outdir) / f"{t}.csv" for t in changed]
+        else:
+            logger.info(f"converting '{outdir}/*.csv' to store ...")
+            paths = sorted(Path(outdir).glob("*.csv"), key=lambda p: int(p.stem))
+        dfs, errors = BCDataAbs.read_csvs(paths, num_workers)
+
+        # 原因は見てないが empty な CSV が生成される場合がある
+        # ex) quarter の 5142.csv
+        empty = sorted([t for t, e in errors.items() if e == "empty"], key=int)
+        if len(empty) > 0:
+            logger.warn(f"empty CSVs in '{outdir}' are skipped ({len(empty)}): {empty}")
+        for t, e in errors.items():
+            if e not in ["missing", "empty"]:
+                logger.warn(f"could not read '{Path(outdir) / f'{t}.csv'}': {e}")
+
+        if incremental:
+            store.update(dfs, [t for t, e in errors.items() if e in ["missing", "empty"]])
+        else:
+            store.write(BCDataStore.concat(list(dfs.values())))
+        return True
 
     @staticmethod
     def replace_value_str(str_list, columns, df_name):
@@ -132,6 +298,8 @@ class BCDataQuarter(BCDataAbs):
     四半期財務データクラス
     """
 
+    PERIOD_KEYS = ["fiscal_year", "fiscal_quarter"]
+
     def __init__(self, data, dic):
         super().__init__(data, dic)
 
@@ -182,15 +350,14 @@ class BCDataQuarter(BCDataAbs):
             列: query 引数の key。
         """
         str_list = query.values()
-        df = pd.concat(self.data.values(), sort=False)
+        df = self.frame
 
         # 使う列だけ抜き出しておく
         columns = [c for c in df.columns if any([c in s for s in str_list])]
         if len(columns) < 1:
             return None
-        columns += ["ticker", "fiscal_year", "fiscal_quarter"]
         # Q4 データが対象
-        y = df.loc[df["fiscal_quarter"] == 4, columns]
+        y = df.loc[df.index.get_level_values("fiscal_quarter") == 4, columns].reset_index()
         if any(["cagr" in s for s in str_list]):
             # 成長率を求める場合は fiscal_year を index に指定しておく。
             # NOTE: set_index するとちょっと遅くなる。
@@ -268,6 +435,8 @@ class BCDataIndicator(BCDataAbs):
     株価指標データクラス
     """
 
+    PERIOD_KEYS = ["day"]
+
     def __init__(self, data, dic):
         super().__init__(data, dic)
 
@@ -276,14 +445,13 @@ class BCDataIndicator(BCDataAbs):
         指定値の取得
         """
         str_list = query.values()
-        df = pd.concat(self.data.values(), sort=False)
+        df = self.frame
 
         # 使う列だけ抜き出しておく
         columns = [c for c in df.columns if any([c in s for s in str_list])]
         if len(columns) < 1:
             return None
-        columns += ["ticker", "day"]
-        df = df.loc[:, columns]
+        df = df.loc[:, columns].reset_index()
 
         # 取得文字列置換
         str_list = BCDataAbs.replace_value_str(str_list, df.columns, "d")
@@ -294,7 +462,8 @@ class BCDataIndicator(BCDataAbs):
             result = []
             for op in str_list:
                 try:
-                    v = eval(op, {}, exec_locals)[0]
+                    # 銘柄の最初の行 (NOTE: index は全銘柄を通した行番号なので位置で取る)
+                    v = eval(op, {}, exec_locals).iloc[0]
                     if v is None:
                         v = np.nan
                 except:
@@ -305,12 +474,90 @@ class BCDataIndicator(BCDataAbs):
         result.columns = query.keys()
         return result
 
+class _BCTickerArrays(Mapping):
+    """
+    memory map した列の配列から、銘柄ごとの dataframe を dict のように返すビュー
+
+    銘柄の dataframe を作るときに、その銘柄の行範囲のページだけが読まれる。
+    """
+
+    def __init__(self, arrays, ranges):
+        self.arrays = arrays
+        self.ranges = ranges
+
+    def __getitem__(self, ticker):
+        s, e = self.ranges[str(ticker)]
+        return pd.DataFrame({n : a.take(slice(s, e)) for n, a in self.arrays.items()})
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
 class BCDataDaily(BCDataAbs):
     """
     daily データクラス
+
+    BCColumnStore から作る場合は列の配列を memory map で開くだけで、データは使うときに読む。
+    (複数プロセスで開いても OS のページキャッシュを共有する)
+    frame は初めて参照したときに全体を読み込んで作る。
     """
+
+    PERIOD_KEYS = ["day"]
+
     def __init__(self, data, dic):
-        super().__init__(data, dic)
+        """
+        Parameters
+        ----------
+        data : BCColumnStore or pd.DataFrame or dict
+            BCColumnStore なら memory map で開く。それ以外は BCDataAbs と同じ
+        dic : dictionary
+            列名定義辞書
+        """
+        self._frame = None
+        if not isinstance(data, BCColumnStore):
+            self.arrays = None
+            super().__init__(data, dic)
+            return
+        meta, self.arrays = data.open_arrays()
+        offsets = meta["offsets"]
+        self.ranges = {str(t) : (offsets[i], offsets[i + 1]) for i, t in enumerate(meta["tickers"])}
+        self.data = _BCTickerArrays(self.arrays, self.ranges)
+        self.dic = dic
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = self.index_frame(pd.DataFrame({n : a.take(slice(None)) for n, a in self.arrays.items()}))
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        self._frame = frame
+
+    def values(self, column, ticker=None):
+        """
+        列の値を numpy 配列で取得する
+
+        memory map で開いている場合、数値列はコピーせずに返す (触ったページだけ読まれる)
+
+        Parameters
+        ----------
+        column : str
+            列名
+        ticker : int or str
+            銘柄コード。None なら全銘柄分 (銘柄順・日付順)
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        if self.arrays is None:
+            df = self.frame.reset_index() if ticker is None else self.data[str(ticker)]
+            return df[column].to_numpy()
+        rows = slice(None) if ticker is None else slice(*self.ranges[str(ticker)])
+        return self.arrays[column].take(rows)
 
     def get_values(self, query):
         # 未対応
@@ -318,6 +565,31 @@ class BCDataDaily(BCDataAbs):
 
 def _read_csv(p):
     return pd.read_csv(p)
+def _merge_with_csv(p, df, keys):
+    """
+    既存 CSV のデータに df をマージする。キーが重複する行は df (新しいデータ) を優先。
+    """
+    try:
+        old = pd.read_csv(p)
+    except pd.errors.EmptyDataError:
+        return df
+    return BCAPI.drop_duplicated(pd.concat([old, df], sort=False), keys)
+def _ingest_csv(p):
+    """
+    CSV を 1 つ読み込む (BCDataAbs.read_csvs() の worker)
+
+    Returns
+    -------
+    (銘柄コード (str), pandas.DataFrame or None, 読めなかった理由 or None)
+    """
+    try:
+        return p.stem, pd.read_csv(p), None
+    except FileNotFoundError:
+        return p.stem, None, "missing"
+    except pd.errors.EmptyDataError:
+        return p.stem, None, "empty"
+    except Exception as e:
+        return p.stem, None, f"{type(e).__name__}: {e}"
 def _read_pickle(p):
     with open(p, mode = "rb") as f:
         return pickle.load(f)
@@ -325,6 +597,597 @@ def _read_json(p):
     with open(p, mode = "r") as f:
             return json.load(f)
 
+class BCDataStore(metaclass=ABCMeta):
+    """
+    データ要素 (quarter, indicator, daily) の全銘柄分をまとめて保存する形式の抽象基底クラス
+
+    {銘柄コード}.csv をまとめたもので、load_xxx() はここから読み込む。
+    列 (columns)・銘柄 (tickers)・期間 (start, end) を指定すると、形式によっては必要な部分だけを読む。
+    期間は quarter なら "2019Q1"、indicator, daily なら "2019-01-01" の形式で指定する (両端を含む)。
+
+    Attributes
+    ----------
+    outdir : Path
+        データディレクトリ
+    mode : str
+        "quarter" or "indicator" or "daily"
+    """
+
+    # 形式名 -> クラス
+    FORMATS = {}
+    # open() で形式を省略した場合の形式
+    DEFAULT_FORMAT = "columns"
+
+    def __init__(self, outdir, mode):
+        self.outdir = Path(outdir)
+        self.mode = mode
+
+    @staticmethod
+    def open(outdir, mode, fmt=None):
+        """
+        データディレクトリのストアを返す
+
+        Parameters
+        ----------
+        outdir : str or Path
+            データディレクトリ
+        mode : str
+            "quarter" or "indicator" or "daily"
+        fmt : str
+            "columns" or "pickle"。None なら DEFAULT_FORMAT
+        """
+        fmt = fmt if fmt is not None else BCDataStore.DEFAULT_FORMAT
+        if fmt not in BCDataStore.FORMATS:
+            raise RuntimeError(f"invalid store format {fmt}")
+        return BCDataStore.FORMATS[fmt](outdir, mode)
+
+    @abstractmethod
+    def exists(self):
+        pass
+
+    @abstractmethod
+    def read_frame(self, columns=None, tickers=None, start=None, end=None):
+        """
+        全銘柄分を連結した dataframe (銘柄順、銘柄内は期間順) を読み込む
+
+        Parameters
+        ----------
+        columns : list
+            読み込む列名。None なら全列 ("ticker" と期間の列は常に含む)
+        tickers : list
+            読み込む銘柄コード。None なら全銘柄
+        start, end : str
+            読み込む期間。None なら制限なし
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        pass
+
+    @abstractmethod
+    def write(self, df):
+        """read_frame() と同じ形の dataframe で全体を書き換える"""
+        pass
+
+    def read(self, columns=None, tickers=None, start=None, end=None):
+        """
+        read_frame() と同じ指定で、銘柄ごとに分けて読み込む
+
+        Returns
+        -------
+        dict
+            {銘柄コード (str) : pandas.DataFrame}
+        """
+        df = self.read_frame(columns, tickers, start, end)
+        return {str(t) : d.reset_index(drop=True) for t, d in df.groupby("ticker", sort=True)}
+
+    def update(self, dfs, removed=()):
+        """
+        一部の銘柄だけ入れ替える
+
+        Parameters
+        ----------
+        dfs : dict
+            {銘柄コード : 新しい dataframe}
+        removed : list
+            除く銘柄コード
+        """
+        replaced = {int(t) for t in dfs.keys()} | {int(t) for t in removed}
+        old = self.read_frame()
+        old = old[~old["ticker"].isin(replaced)]
+        self.write(BCDataStore.concat([old] + list(dfs.values())))
+
+    def period_keys(self):
+        """期間を表す列"""
+        return ["fiscal_year", "fiscal_quarter"] if self.mode == "quarter" else ["day"]
+
+    def period_mask(self, periods, start=None, end=None):
+        """
+        期間が start ～ end に入る行
+
+        Parameters
+        ----------
+        periods : dict
+            {period_keys() の列名 : 値の配列}
+        """
+        if self.mode == "quarter":
+            p = np.asarray(periods["fiscal_year"]) * 4 + np.asarray(periods["fiscal_quarter"]) - 1
+            def _key(s):
+                y, q = [int(v) for v in s.split("Q")]
+                return y * 4 + q - 1
+        else:
+            p = np.asarray(periods["day"]).astype(str)
+            _key = str
+        mask = np.ones(len(p), dtype=bool)
+        if start is not None:
+            mask &= p >= _key(start)
+        if end is not None:
+            mask &= p <= _key(end)
+        return mask
+
+    @staticmethod
+    def concat(dfs):
+        """dataframe のリストを銘柄順に連結する (銘柄内の順番は保つ)"""
+        dfs = [d for d in dfs if d is not None and len(d) > 0]
+        if len(dfs) < 1:
+            return pd.DataFrame({"ticker" : pd.Series([], dtype="int64")})
+        df = pd.concat(dfs, sort=False, ignore_index=True)
+        if df["ticker"].is_monotonic_increasing:
+            # 銘柄順に読み込んだ場合は並べ替え (コピー) しない
+            return df
+        return df.sort_values("ticker", kind="mergesort").reset_index(drop=True)
+
+class BCPickleStore(BCDataStore):
+    """
+    {outdir}/all.pickle に {銘柄コード: pandas.DataFrame} の dict を保存する形式 (従来の形式)
+
+    読み込みは常に全体を unpickle してから絞り込む。
+    """
+
+    def __init__(self, outdir, mode):
+        super().__init__(outdir, mode)
+        self.path = self.outdir / "all.pickle"
+
+    def exists(self):
+        return self.path.exists()
+
+    def read_frame(self, columns=None, tickers=None, start=None, end=None):
+        dfs = _read_pickle(self.path)
+        if tickers is not None:
+            dfs = {t : dfs[t] for t in [str(t) for t in tickers] if t in dfs}
+        df = BCDataStore.concat(list(dfs.values()))
+        if len(df) > 0 and (start is not None or end is not None):
+            df = df[self.period_mask({k : df[k] for k in self.period_keys()}, start, end)]
+        if columns is not None:
+            keep = ["ticker"] + self.period_keys() + [c for c in columns if c not in ["ticker"] + self.period_keys()]
+            df = df[[c for c in keep if c in df.columns]]
+        return df.reset_index(drop=True)
+
+    def write(self, df):
+        dfs = {str(t) : d.reset_index(drop=True) for t, d in df.groupby("ticker", sort=True)}
+        with open(self.path, mode = "wb") as f:
+            pickle.dump(dfs, f)
+
+class _BCColumnArray:
+    """
+    BCColumnStore の 1 列分の配列
+    """
+
+    def __init__(self, path, col):
+        self.col = col
+        if col["kind"] == "obj":
+            self.values = np.load(path / col["file"], allow_pickle=True)
+        else:
+            self.values = np.load(path / col["file"], mmap_mode="r")
+        self.categories = None
+        if col["kind"] == "str":
+            # 値の一覧とそのインデックス (-1 は欠損) に分けてある
+            self.categories = np.append(np.load(path / col["categories"]).astype(object), np.nan)
+
+    def take(self, rows):
+        """
+        rows 行 (slice or index 配列) の値
+
+        数値列を slice で取る場合はコピーせず memory map のまま返す (触ったページだけ読まれる)
+        """
+        values = np.asarray(self.values[rows])
+        if self.categories is not None:
+            return self.categories[values]
+        return values
+
+class BCColumnStore(BCDataStore):
+    """
+    {outdir}/store/ に列ごとの numpy 配列 (.npy) として保存する形式
+
+    行は銘柄順 (銘柄内は期間順) に並べ、meta.json に列の定義と銘柄ごとの行の範囲 (offsets) を持つ。
+    配列は memory map で開くので、指定した列・銘柄の範囲だけが読まれる。
+    期間の指定は期間の列だけを先に読んで行を絞り、その行だけ他の列を読む。
+
+    書き込みのたびに store/gen-{番号}/ に新しい世代を作り、store/meta.json の current を切り替える。
+    開いている配列 (memory map) のファイルは書き換えないので、読み込み中のものは開いた世代のまま使える。
+    古い世代は次の書き込み時に消す (Windows で memory map 中のため消せないものはさらに次に回す)。
+
+    列の種類 (meta.json の kind)
+     * "num" : 数値・bool 列。そのまま保存
+     * "str" : 文字列列。値の一覧 (categories) と各行の値のインデックス (欠損は -1) の配列で保存
+     * "obj" : それ以外 (型の混じった列など)。pickle した object 配列で保存 (memory map しない)
+    """
+
+    VERSION = 2
+
+    def __init__(self, outdir, mode):
+        super().__init__(outdir, mode)
+        self.path = self.outdir / "store"
+
+    def exists(self):
+        return (self.path / "meta.json").exists()
+
+    def current(self):
+        """今の世代のディレクトリ"""
+        head = _read_json(self.path / "meta.json")
+        if "current" not in head:
+            # 世代を分ける前 (VERSION 1) の形式
+            return self.path
+        return self.path / head["current"]
+
+    def meta(self):
+        return _read_json(self.current() / "meta.json")
+
+    def open_arrays(self, names=None):
+        """
+        列の配列を開く (数値列・文字列列は memory map なので、この時点ではデータを読まない)
+
+        開いた配列は、後でストアが書き換えられても開いた時点の内容のまま使える。
+
+        Parameters
+        ----------
+        names : list
+            開く列名。None なら全列
+
+        Returns
+        -------
+        meta : dict
+            meta.json の内容
+        arrays : dict
+            {列名 : _BCColumnArray}
+        """
+        return self.__open(lambda meta : names)
+
+    def __open(self, select):
+        """
+        今の世代の meta.json と、select(meta) の列 (None なら全列) の配列を開く
+
+        世代を決めてから開くまでの間に書き換えられて古い世代が消えた場合は、新しい世代で開き直す
+        """
+        for retry in [True, False]:
+            path = self.current()
+            try:
+                meta = _read_json(path / "meta.json")
+                names = select(meta)
+                return meta, {c["name"] : _BCColumnArray(path, c) for c in meta["columns"] if names is None or c["name"] in names}
+            except FileNotFoundError:
+                if not retry:
+                    raise
+
+    def read_frame(self, columns=None, tickers=None, start=None, end=None):
+        def _names(meta):
+            names = [c["name"] for c in meta["columns"]]
+            if columns is not None:
+                keep = set(["ticker"] + self.period_keys() + list(columns))
+                names = [n for n in names if n in keep]
+            return names
+        # 期間で絞る場合は期間の列も開く
+        meta, arrays = self.__open(lambda meta : set(_names(meta)) | set(self.period_keys()))
+        names = _names(meta)
+        if tickers is None:
+            rows = slice(0, meta["num_rows"])
+        else:
+            index = {t : i for i, t in enumerate(meta["tickers"])}
+            offsets = meta["offsets"]
+            ranges = [(offsets[index[int(t)]], offsets[index[int(t)] + 1]) for t in tickers if int(t) in index]
+            ranges.sort()
+            rows = np.concatenate([np.arange(s, e) for s, e in ranges]) if len(ranges) > 0 else np.array([], dtype=np.int64)
+        if start is not None or end is not None:
+            periods = {k : arrays[k].take(rows) for k in self.period_keys() if k in arrays}
+            if len(periods) == len(self.period_keys()):
+                mask = self.period_mask(periods, start, end)
+                rows = np.arange(meta["num_rows"])[rows][mask]
+        return pd.DataFrame({n : arrays[n].take(rows) for n in names})
+
+    def write(self, df):
+        self.path.mkdir(parents=True, exist_ok=True)
+        gens = [int(p.name[4:]) for p in self.path.glob("gen-*") if p.name[4:].isdigit()]
+        gen = f"gen-{max(gens, default=0) + 1}"
+        tmp = self.path / f"{gen}.tmp"
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir()
+
+        columns = []
+        for i, (name, s) in enumerate(df.items()):
+            col = {"name" : name, "file" : f"{i}.npy"}
+            values = s.to_numpy()
+            if s.dtype.kind in "biuf":
+                col["kind"] = "num"
+            else:
+                values = values.astype(object)
+                null = pd.isna(values)
+                if all([isinstance(v, str) for v in values[~null]]):
+                    # 日付・業種など同じ値が多いので、値の一覧とそのインデックスに分ける
+                    col["kind"] = "str"
+                    col["categories"] = f"{i}.categories.npy"
+                    codes, categories = pd.factorize(values)
+                    np.save(tmp / col["categories"], np.array(categories, dtype=str))
+                    values = codes.astype(np.int32)
+                else:
+                    col["kind"] = "obj"
+            np.save(tmp / col["file"], values, allow_pickle=(col["kind"] == "obj"))
+            columns.append(col)
+
+        tickers, starts = np.unique(df["ticker"].to_numpy(), return_index=True)
+        meta = {
+            "version" : BCColumnStore.VERSION,
+            "mode" : self.mode,
+            "num_rows" : len(df),
+            "columns" : columns,
+            "tickers" : [int(t) for t in tickers],
+            "offsets" : [int(o) for o in starts] + [len(df)],
+        }
+        with open(tmp / "meta.json", "w") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=4)
+
+        # 新しい世代に切り替える (読み込み中のものは古い世代を見続ける)
+        tmp.replace(self.path / gen)
+        head = self.path / "meta.json.tmp"
+        with open(head, "w") as f:
+            json.dump({"version" : BCColumnStore.VERSION, "current" : gen}, f, indent=4)
+        head.replace(self.path / "meta.json")
+        self.__remove_old(gen)
+
+    def __remove_old(self, gen):
+        """今の世代 gen 以外を消す。memory map 中などで消せないものは次回に回す"""
+        olds = [p for p in self.path.iterdir() if p.name not in (gen, "meta.json")]
+        # VERSION 1 の書き込み途中のもの
+        olds += [p for p in [self.outdir / "store.tmp", self.outdir / "store.old"] if p.exists()]
+        for p in olds:
+            try:
+                if p.is_dir():
+                    shutil.rmtree(p)
+                else:
+                    p.unlink()
+            except OSError as e:
+                logger.debug(f"could not remove old store '{p}' ({e})")
+
+BCDataStore.FORMATS = {"columns" : BCColumnStore, "pickle" : BCPickleStore}
+
+class BCDataManifest:
+    """
+    銘柄ごとの CSV のサイズ・更新時刻・内容のハッシュを記録するマニフェスト ({outdir}/manifest.json)
+
+    書き込む内容のハッシュが前回書いたものと同じで CSV もそのまま残っていれば書き込みを省略し、
+    実際に内容が変わった銘柄だけを changed に記録する (ストアの更新などはこの銘柄だけ行う)。
+    取得以外で CSV が追加・変更・削除された場合も scan() で見つけて changed に入れる。
+    changed はストアに反映するまで保存しておくので、中断して再開した場合も書き込み済みの銘柄が漏れない。
+
+    Attributes
+    ----------
+    path : Path
+        マニフェストファイル
+    entries : dict
+        {銘柄コード (str) : {"sha256" : ハッシュ, "size" : バイト数, "mtime" : 更新時刻 [ns], "fetched_at" : 最後に取得した時刻 [sec]}}
+        fetched_at は内容が同じで書き込みを省略した場合も更新する (CSV の更新時刻は古いままなので)
+    changed : set
+        内容が変わった (削除を含む) がまだストアに反映していない銘柄コード
+    """
+
+    def __init__(self, outdir):
+        self.path = Path(outdir) / "manifest.json"
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = set()
+        if self.path.exists():
+            try:
+                d = _read_json(self.path)
+                self.entries = d["entries"]
+                self.changed = set(d["changed"])
+            except (json.JSONDecodeError, KeyError):
+                logger.warn(f"ignoring broken manifest '{self.path}'")
+
+    def write(self, p, data):
+        """
+        内容が変わっていれば data (bytes) を p に書き込む。取得した時刻はどちらの場合も記録する
+
+        Returns
+        -------
+        bool
+            書き込んだら True、内容が同じで省略したら False
+        """
+        p = Path(p)
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            entry = self.entries.get(p.stem)
+            size = p.stat().st_size if p.exists() else None
+            if entry is not None and entry["sha256"] == digest and entry["size"] == size:
+                entry["fetched_at"] = time.time()
+                return False
+            with open(p, mode = "wb") as f:
+                f.write(data)
+            self.entries[p.stem] = {"sha256" : digest, "size" : len(data), "mtime" : p.stat().st_mtime_ns, "fetched_at" : time.time()}
+            self.changed.add(int(p.stem))
+            return True
+
+    def scan(self):
+        """
+        ディレクトリの CSV を記録と比べ、追加・変更・削除された銘柄を changed に入れる
+
+        サイズ・更新時刻が記録と同じ CSV は読まない。違う場合はハッシュを比べ、内容が同じなら記録だけ直す。
+
+        Returns
+        -------
+        bool
+            記録を直したら True
+        """
+        modified = False
+        with self.lock:
+            paths = {p.stem : p for p in self.path.parent.glob("*.csv")}
+            for t in [t for t in self.entries.keys() if t not in paths]:
+                del self.entries[t]
+                self.changed.add(int(t))
+                modified = True
+            for t, p in paths.items():
+                stat = p.stat()
+                entry = self.entries.get(t)
+                if entry is not None and entry["size"] == stat.st_size and entry.get("mtime") == stat.st_mtime_ns:
+                    continue
+                with open(p, mode = "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                if entry is None or entry["sha256"] != digest:
+                    self.changed.add(int(t))
+                self.entries[t] = {"sha256" : digest, "size" : stat.st_size, "mtime" : stat.st_mtime_ns}
+                if entry is not None and "fetched_at" in entry:
+                    self.entries[t]["fetched_at"] = entry["fetched_at"]
+                modified = True
+        return modified
+
+    def commit(self):
+        """changed をストアに反映したので空にして保存する"""
+        with self.lock:
+            self.changed = set()
+        self.save()
+
+    def save(self):
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            with open(tmp, "w") as f:
+                json.dump({"entries" : self.entries, "changed" : sorted(self.changed)}, f, indent=4, sort_keys=True)
+            tmp.replace(self.path)
+
+class BCRefreshPolicy:
+    """
+    データの古さから銘柄ごとの更新の優先度 (スコア) を求め、リクエスト数の予算内で取得する計画を選ぶ
+
+    スコア = (足りない期間数 + 最後の取得からの経過日数 / STALE_DAYS) * 時価総額による重み
+     * 足りない期間数: quarter は決算が出ているはずの最新四半期まで何四半期足りないか (3月決算とみなす)、
+       daily は今日まで何営業日足りないか。indicator は 0 (経過日数のみ)
+     * 最後の取得からの経過日数: マニフェストの取得時刻 (記録がなければ CSV の更新時刻) から。CSV がなければ未取得として最優先
+     * 時価総額による重み: 1 + log10(時価総額 / 中央値) を [0.5, 3] に丸めたもの。時価総額が不明なら 1
+
+    Attributes
+    ----------
+    mode : str
+        "quarter" or "indicator" or "daily"
+    outdir : Path
+        データの保存先ディレクトリ
+    market_caps : dict
+        {銘柄コード: 時価総額}
+    """
+
+    # 四半期末から決算が出るまでの日数の見込み
+    FILING_LAG = 45
+    # 最後の取得からこの日数たつごとにスコア +1
+    STALE_DAYS = 30
+    # 未取得の銘柄のスコア
+    NEVER_FETCHED = 1e6
+
+    def __init__(self, mode, outdir, market_caps=None):
+        self.mode = mode
+        self.outdir = Path(outdir)
+        self.market_caps = market_caps if market_caps is not None else {}
+        caps = sorted([v for v in self.market_caps.values() if v > 0])
+        self.median_cap = caps[len(caps) // 2] if len(caps) > 0 else None
+        # 内容が同じで書き込まなかった CSV は更新時刻が古いままなので、取得時刻はマニフェストから
+        self.fetched_at = {t : e["fetched_at"] for t, e in BCDataManifest(self.outdir).entries.items() if "fetched_at" in e}
+        self.scores = {}
+
+    @staticmethod
+    def expected_quarter(today=None):
+        """決算が出ているはずの最新四半期 (通し番号 年度 * 4 + 四半期 - 1)"""
+        today = today if today is not None else date.today()
+        d = today - timedelta(days=BCRefreshPolicy.FILING_LAG)
+        for n in range((d.year + 1) * 4, (d.year - 2) * 4, -1):
+            y, q = n // 4, n % 4 + 1
+            # 3月決算の四半期末 (翌月 1 日の前日)
+            m = q * 3 + 3
+            end = date(y + m // 12, m % 12 + 1, 1) - timedelta(days=1)
+            if end <= d:
+                return n
+        raise RuntimeError(f"invalid date {today}")
+
+    def __missing(self, p):
+        """CSV p に足りない期間数"""
+        today = date.today()
+        try:
+            if self.mode == "quarter":
+                df = pd.read_csv(p, usecols=["fiscal_year", "fiscal_quarter"])
+                if len(df) < 1:
+                    return 0
+                latest = int((df["fiscal_year"] * 4 + df["fiscal_quarter"] - 1).max())
+                return max(BCRefreshPolicy.expected_quarter(today) - latest, 0)
+            if self.mode == "daily":
+                days = pd.read_csv(p, usecols=["day"])["day"]
+                if len(days) < 1:
+                    return 0
+                last = date.fromisoformat(days.max())
+                return int(np.busday_count(last + timedelta(days=1), today)) if last < today else 0
+        except (pd.errors.EmptyDataError, ValueError):
+            pass
+        return 0
+
+    def score(self, ticker):
+        if ticker in self.scores:
+            return self.scores[ticker]
+        cap = self.market_caps.get(ticker)
+        weight = 1.0
+        if cap is not None and cap > 0 and self.median_cap is not None:
+            weight = min(max(1 + np.log10(cap / self.median_cap), 0.5), 3.0)
+        p = self.outdir / f"{ticker}.csv"
+        if not p.exists():
+            score = BCRefreshPolicy.NEVER_FETCHED * weight
+        else:
+            fetched_at = self.fetched_at.get(str(ticker), p.stat().st_mtime)
+            age = (time.time() - fetched_at) / 86400
+            score = (self.__missing(p) + age / BCRefreshPolicy.STALE_DAYS) * weight
+        self.scores[ticker] = score
+        return score
+
+    def select(self, plan, budget, max_num_year=None, cost=None):
+        """
+        スコアの高い銘柄を含むグループから順に、リクエスト数が budget 以下になるよう計画を選ぶ
+
+        Parameters
+        ----------
+        plan : list
+            BCRequestPlanner.plan() の結果
+        budget : int
+            使えるリクエスト数
+        max_num_year : int
+            四半期データの 1 リクエストで指定できる年数
+        cost : function
+            グループ 1 つを取得するのに API に投げるリクエスト数。
+            省略時は BCRequestPlanner.num_requests() (キャッシュなどから返せる分も数える)
+
+        Returns
+        -------
+        selected : list
+            今回取得する計画 (スコア順)
+        deferred : list
+            次回に回す計画
+        """
+        ordered = sorted(plan, key=lambda g: (-max([self.score(t) for t in g[0]]), g[0]))
+        selected = []
+        deferred = []
+        n = 0
+        for g in ordered:
+            k = cost(g) if cost is not None else BCRequestPlanner.num_requests(self.mode, [g], max_num_year)
+            if n + k <= budget:
+                selected.append(g)
+                n += k
+            else:
+                deferred.append(g)
+        return selected, deferred
+
 class BCData:
     """
     バフェットコード API データを扱う
@@ -341,8 +1204,13 @@ class BCData:
         株価指標データ
     plot_caches : pd.DataFrame
         プロット用データのキャッシュ
+    changed_tickers : dict
+        {mode : 直近の取得で CSV の内容が変わった銘柄コードのリスト}
     """
 
+    # 銘柄ごとに CSV を持つデータ
+    ELEM_MODES = ("quarter", "indicator", "daily")
+
     def __init__(self, root_dir, load_quarter=False, load_indicator=False, load_daily=False):
         self.root_dir = Path(root_dir)
 
@@ -360,6 +1228,7 @@ class BCData:
             self.load_daily()
 
         self.plot_caches = pd.DataFrame()
+        self.changed_tickers = {}
 
     def load_company(self):
         d = self.root_dir / "company"
@@ -373,44 +1242,85 @@ class BCData:
             logger.info(f"loaded company data")
     def load_quarter(self):
         d = self.root_dir / "quarter"
-        pkl = d / "all.pickle"
+        store = BCDataStore.open(d, "quarter")
         json = d / "columns.json"
         if not (d.exists() and json.exists()):
             self.quarter = None
             logger.info(f"could not load quarter data")
         else:
-            if not pkl.exists():
-                # pickle ファイルがなければ作る
-                BCDataAbs.csvs_to_pickle(d)
-            self.quarter = BCDataQuarter(_read_pickle(pkl), _read_json(json))
+            # ストアがない・CSV より古い場合は作る (変わった銘柄だけ読み直す)
+            self.__sync_store("quarter")
+            self.quarter = BCDataQuarter(store.read_frame(), _read_json(json))
             logger.info(f"loaded quarter data")
     def load_indicator(self):
         d = self.root_dir / "indicator"
-        pkl = d / "all.pickle"
+        store = BCDataStore.open(d, "indicator")
         json = d / "columns.json"
         if not (d.exists() and json.exists()):
             self.indicator = None
             logger.info(f"could not load indicator data")
         else:
-            if not pkl.exists():
-                # pickle ファイルがなければ作る
-                BCDataAbs.csvs_to_pickle(d)
-            self.indicator = BCDataIndicator(_read_pickle(pkl), _read_json(json))
+            # ストアがない・CSV より古い場合は作る (変わった銘柄だけ読み直す)
+            self.__sync_store("indicator")
+            self.indicator = BCDataIndicator(store.read_frame(), _read_json(json))
             logger.info(f"loaded indicator data")
     def load_daily(self):
         d = self.root_dir / "daily"
-        pkl = d / "all.pickle"
+        store = BCDataStore.open(d, "daily")
         json = d / "columns.json"
         if not (d.exists() and json.exists()):
             self.daily = None
             logger.info(f"could not load daily data")
         else:
-            if not pkl.exists():
-                # pickle ファイルがなければ作る
-                BCDataAbs.csvs_to_pickle(d)
-            self.daily = BCDataDaily(_read_pickle(pkl), _read_json(json))
+            # ストアがない・CSV より古い場合は作る (変わった銘柄だけ読み直す)
+            self.__sync_store("daily")
+            # 列ごとの形式なら memory map で開くだけ (データは使うときに読む)
+            self.daily = BCDataDaily(store if isinstance(store, BCColumnStore) else store.read_frame(), _read_json(json))
             logger.info(f"loaded daily data")
 
+    def __attach_cache(self, api):
+        # API レスポンスのキャッシュ・銘柄数などの調整結果は root_dir 以下に置く (api 側で指定済みならそちらを使う)
+        if api.cache is None:
+            api.cache = BCResponseCache(self.root_dir / "cache")
+        if api.batch is None:
+            api.batch = BCBatchTuner(self.root_dir / "batch.json")
+        # quota の消費数も root_dir 以下に保存して、別の実行に引き継ぐ
+        if api.limiter.state_path is None:
+            api.limiter.attach(self.root_dir / "quota.json")
+
+    def probe_batch_limits(self, api, num_tickers=None):
+        """
+        1 リクエストでまとめられる銘柄数・年数の上限をサーバーに問い合わせて調べ、root_dir 以下に保存する
+
+        NOTE: 数リクエスト～十数リクエスト分の quota を消費する
+
+        Parameters
+        ----------
+        api : BCAPI インスタンス
+        num_tickers : int
+            試す銘柄数の上限 (省略時は BCBatchTuner の既定値)
+
+        Returns
+        -------
+        dict
+            {"num_company": 銘柄数, "num_year": 年数}
+        """
+        if self.company is None:
+            raise RuntimeError(f"company is not loaded!")
+        self.__attach_cache(api)
+        if num_tickers is not None:
+            api.batch.ceiling["num_company"] = num_tickers
+        # 確実にデータがある銘柄で試したいので上場の古い順に使う
+        tickers = self.company.tickers()
+        if "listing_date" in self.company.data.columns:
+            tickers = list(self.company.data.sort_values("listing_date")["ticker"])
+        # キャッシュが効くと調べられないので外しておく
+        cache, api.cache = api.cache, None
+        try:
+            return api.batch.probe(api, tickers)
+        finally:
+            api.cache = cache
+
     def fetch_company(self, api, retry=-1, overwrite=False):
         """API 指標データ取得関数
 
@@ -423,11 +1333,18 @@ class BCData:
         ----------
         api : BCAPI インスタンス
         retry : int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係な 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
         overwrite: bool
             既存のCSVを上書きするか
+
+        Returns
+        -------
+        dict
+            前回の company データとの差分 (BCDataCompany.diff())。前回のデータがなければ None
+            追加された銘柄は quarter, indicator, daily の取得待ち (added_only で取得) として記録し、
+            なくなった銘柄の CSV は各データディレクトリの archive/ に移す。
         """
 
         d = self.root_dir / "company"
@@ -437,36 +1354,147 @@ class BCData:
 
         if outpath_csv.exists() and not overwrite:
             logger.warn(f"'company.csv' already exists! Skipped fetching.")
-            return
+            return None
 
         # API からデータ取得
-        df, dic = api.get_company(retry)
+        self.__attach_cache(api)
+        job = api.stats.start_job("company")
+        try:
+            df, dic = api.get_company(retry)
+        finally:
+            api.stats.end_job()
+            api.stats.log_summary(job)
         logger.info(f"making '{outpath_csv}' ...")
         df.to_csv(outpath_csv, index=False, encoding="utf_8_sig")
         with open(outpath_json, "w") as f:
             json.dump(dic, f, ensure_ascii=False, indent=4)
 
+        old = self.company
         self.load_company()
+        if old is None:
+            return None
 
-    def __fetch_elem(self, mode, api, retry=-1, overwrite=False, config=None):
-        """API データ(quarter, indicator, daily) 取得内部関数
+        # 前回との差分 (新規上場・上場廃止・業種変更など)
+        diff = BCDataCompany.diff(old.data, self.company.data)
+        logger.info(f"company universe: {len(diff['added'])} added, {len(diff['removed'])} removed, {len(diff['changed'])} changed")
+        universe = self.__read_universe()
+        for mode in BCData.ELEM_MODES:
+            pending = set(universe["pending"].get(mode, [])) | set(diff["added"])
+            universe["pending"][mode] = sorted(pending - set(diff["removed"]))
+        universe["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        universe["diff"] = diff
+        self.__write_universe(universe)
+        # なくなった銘柄の CSV は退避する
+        for mode in BCData.ELEM_MODES:
+            self.__archive(mode, diff["removed"])
+        return diff
+
+    def __universe_path(self):
+        return self.root_dir / "company" / "universe.json"
+
+    def __read_universe(self):
+        """
+        会社一覧の差分と取得待ちの銘柄 (company/universe.json)
+
+        Returns
+        -------
+        dict
+            updated_at : str
+                最後に差分を求めた日時
+            diff : dict
+                最後の差分 (BCDataCompany.diff())
+            pending : dict
+                {mode : 追加されてまだ取得していない銘柄コードのリスト}
+        """
+        p = self.__universe_path()
+        if p.exists():
+            try:
+                return _read_json(p)
+            except json.JSONDecodeError:
+                logger.warn(f"ignoring broken '{p}'")
+        return {"updated_at" : None, "diff" : None, "pending" : {}}
+
+    def __write_universe(self, universe):
+        p = self.__universe_path()
+        tmp = p.with_name(f"{p.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(universe, f, indent=4)
+        tmp.replace(p)
+
+    def __done_pending(self, mode, tickers):
+        universe = self.__read_universe()
+        pending = universe["pending"].get(mode, [])
+        if len(set(pending) & set(tickers)) < 1:
+            return
+        universe["pending"][mode] = sorted(set(pending) - set(tickers))
+        self.__write_universe(universe)
+
+    def pending_tickers(self, mode):
+        """会社一覧に追加されて、まだ mode のデータを取得していない銘柄コード"""
+        return self.__read_universe()["pending"].get(mode, [])
+
+    def __archive(self, mode, tickers):
+        """
+        会社一覧にない銘柄の CSV を {mode}/archive/ に移し、ストアからも除く
+        """
+        outdir = self.root_dir / mode
+        archived = []
+        for t in tickers:
+            p = outdir / f"{t}.csv"
+            if not p.exists():
+                continue
+            (outdir / "archive").mkdir(exist_ok=True)
+            p.replace(outdir / "archive" / p.name)
+            archived.append(t)
+        if len(archived) < 1:
+            return
+        logger.info(f"archived CSVs of {len(archived)} removed tickers to '{outdir / 'archive'}' ({archived})")
+        if self.__sync_store(mode) and getattr(self, mode) is not None:
+            getattr(self, f"load_{mode}")()
+
+    def __sync_store(self, mode):
+        """
+        {mode}/ の CSV の変更 (追加・変更・削除) をストアに反映する
+
+        マニフェストと比べて変わった銘柄だけ読み直す。ストアがなければ全 CSV から作る。
+
+        Returns
+        -------
+        bool
+            ストアを書き換えたら True
+        """
+        d = self.root_dir / mode
+        manifest = BCDataManifest(d)
+        modified = manifest.scan()
+        if not BCDataStore.open(d, mode).exists():
+            updated = BCDataAbs.csvs_to_store(d, mode)
+        else:
+            updated = BCDataAbs.csvs_to_store(d, mode, sorted(manifest.changed))
+        if updated or modified:
+            manifest.commit()
+        return updated
+
+    def __plan(self, mode, api, overwrite, config, readonly=False):
+        """
+        取得対象の銘柄・期間を求めて取得計画を立てる (引数は __fetch_elem() と同じ)
 
         Parameters
         ----------
-        mode : str
-            取得対象 ("quarter" or "indicator" or "daily")
-        api : BCAPI インスタンス
-        retry : int
-        overwrite: bool
-        config: dict
-            mode 固有の追加情報
-                * quarter, daily の場合
-                    start : str
-                        開始年 (ex. "2012")
-                    end : str
-                        終了年 (ex. "2015")
-        """
+        readonly : bool
+            True ならディレクトリ作成・別ジョブのジャーナルの破棄などをしない (見積もり用)
 
+        Returns
+        -------
+        outdir : Path
+        journal : BCFetchJournal
+        targets : list
+            取得対象の銘柄コード
+        ranges : dict
+            {銘柄コード: (開始, 終了)}
+        planner : BCRequestPlanner
+        plan : list
+            取得計画 (targets が空なら None)
+        """
         if self.company is None:
             raise RuntimeError(f"company is not loaded!")
         tickers = self.company.tickers()
@@ -480,69 +1508,329 @@ class BCData:
         else:
             raise RuntimeError(f"invalid mode {mode}")
 
-        outdir.mkdir(parents=True, exist_ok=True)
+        if not readonly:
+            outdir.mkdir(parents=True, exist_ok=True)
+
+        # 中断したジョブのジャーナルがあれば続きから再開する
+        journal = BCFetchJournal(outdir / "journal", {"mode" : mode, "overwrite" : overwrite, "config" : config}, discard=not readonly)
 
         exist_tickers = [int(p.stem) for p in list(Path(outdir).glob("*.csv"))]
-        undefined_tickers = list(set(exist_tickers) - set(tickers))
-        if len(undefined_tickers) > 0:
-            # 指定外の銘柄の CSV が存在。ファイル削除する？
-            logger.warn(f"CSVs with invalid tickers exist ({undefined_tickers})!!")
-        # overwrite==False なら既に取得済みのものは飛ばす
-        if not overwrite:
+        undefined_tickers = sorted(set(exist_tickers) - set(tickers))
+        if len(undefined_tickers) > 0 and not readonly:
+            # 会社一覧にない (上場廃止などの) 銘柄の CSV は退避する
+            self.__archive(mode, undefined_tickers)
+            exist_tickers = [t for t in exist_tickers if t not in undefined_tickers]
+        incremental = config.get("incremental", False)
+        # overwrite==False なら既に取得済みのものは飛ばす (差分取得の場合は既存のものも対象)
+        if not overwrite and not incremental:
             targets = list(set(tickers) - set(exist_tickers))
         else:
             targets = tickers
+        if config.get("added_only", False):
+            # 会社一覧に追加されてまだ取得していない銘柄だけ
+            targets = list(set(targets) & set(self.pending_tickers(mode)))
+        # ジャーナルで完了済みの銘柄も飛ばす (データなしで CSV を出力しなかった銘柄を含む)
+        targets = list(set(targets) - journal.done_tickers())
         targets.sort()
 
+        if len(targets) < 1:
+            return outdir, journal, targets, {}, None, None
+
+        # 銘柄ごとの取得期間を求めて取得計画を立てる
+        if mode == "quarter":
+            # 開始は Q1, 終了は Q4 で固定
+            start_q = f"{config['start']}Q1"
+            end_q = f"{config['end']}Q4"
+            if not incremental:
+                ranges = {t : (start_q, end_q) for t in targets}
+            else:
+                end_q = f"{min(int(config['end']), date.today().year)}Q4"
+                ranges = BCData.__quarter_ranges(outdir, targets, start_q, end_q, config.get("lookback", 0))
+        elif mode == "indicator":
+            ranges = {t : (None, None) for t in targets}
+        elif mode == "daily":
+            # 開始は 1月1日, 終了は 12月31日で固定
+            start_day = f"{config['start']}-01-01"
+            end_day = f"{config['end']}-12-31"
+            if not incremental:
+                ranges = {t : (start_day, end_day) for t in targets}
+            else:
+                end_day = min(end_day, date.today().isoformat())
+                ranges = BCData.__daily_ranges(outdir, targets, start_day, end_day)
+        self.__attach_cache(api)
+        planner = BCRequestPlanner(self.root_dir / "planner.json")
+        plan = planner.plan(mode, ranges, api.num_company(mode), api.num_year())
+        return outdir, journal, targets, ranges, planner, plan
+
+    def __fetch_elem(self, mode, api, retry=-1, overwrite=False, config=None, dry_run=False, budget=None):
+        """API データ(quarter, indicator, daily) 取得内部関数
+
+        Parameters
+        ----------
+        mode : str
+            取得対象 ("quarter" or "indicator" or "daily")
+        api : BCAPI インスタンス
+        retry : int
+        overwrite: bool
+        config: dict
+            mode 固有の追加情報
+                * quarter, daily の場合
+                    start : str
+                        開始年 (ex. "2012")
+                    end : str
+                        終了年 (ex. "2015")
+                    incremental : bool
+                        True なら既存 CSV の最新データより後だけを取得してマージする
+                * quarter の場合
+                    lookback : int
+                        incremental の場合に、最新四半期から何四半期さかのぼって再取得するか (修正反映用)
+                * 共通
+                    added_only : bool
+                        True なら会社一覧に追加されてまだ取得していない銘柄だけを取得する
+        dry_run: bool
+            True なら取得せず、取得計画のリクエスト数と所要時間の見込みをログ出力するだけ (ファイルは変更しない)
+        budget: int
+            今回使うリクエスト数の上限。None なら limiter の quota の残り (quota なしなら上限なし)
+            足りない場合はデータの古い銘柄から取得し、残りは次回に回す (BCRefreshPolicy)
+            キャッシュ・ジャーナルから返せるリクエストは数えない。使う分は limiter から確保するので、
+            limiter を共有する他のジョブと quota を取り合って超えることはない。
+            途中で quota を使い切った場合も待たずに残りを次回に回す
+
+        Returns
+        -------
+        list
+            予算不足で次回に回した銘柄コード
+        """
+
+        # dry_run ではディレクトリ作成・CSV の退避・ジャーナルの破棄などをしない
+        outdir, journal, targets, ranges, planner, plan = self.__plan(mode, api, overwrite, config, readonly=dry_run)
+        incremental = config.get("incremental", False)
+        deferred = []
         if len(targets) < 1:
             logger.warn(f"Target tickers are empty!!")
-            return
+            if not dry_run:
+                journal.clear()
+            return []
         else:
             columns_outpath = outdir / "columns.json"
+            manifest = BCDataManifest(outdir)
             need_output_columns = overwrite or not columns_outpath.exists()
+            # 差分取得時のマージに使うキー
+            keys = ["ticker", "fiscal_year", "fiscal_quarter"] if mode == "quarter" else ["ticker", "day"]
 
             def _write_csv(ticker, df, col_dict):
                 nonlocal need_output_columns
                 if df is not None:
-                    outpath = f"{outdir}/{ticker}.csv"
-                    logger.info(f"making '{outpath}' ...")
-                    df.to_csv(outpath, index=False, encoding="utf_8_sig")
+                    outpath = outdir / f"{ticker}.csv"
+                    if incremental and outpath.exists():
+                        df = _merge_with_csv(outpath, df, keys)
+                    # 内容が前回と同じなら書き込まない
+                    if manifest.write(outpath, df.to_csv(index=False).encode("utf_8_sig")):
+                        logger.info(f"{'merged into' if incremental else 'made'} '{outpath}'")
+                    else:
+                        logger.debug(f"'{outpath}' is unchanged")
                 if need_output_columns:
                     # 最初の一回だけ出力
                     with open(columns_outpath, "w") as f:
                         json.dump(col_dict, f, ensure_ascii=False, indent=4)
                     need_output_columns = False
+                journal.mark_done(ticker)
+
+            # キャッシュ・ジャーナルから返せないリクエストの数
+            def _cost(g):
+                return len([r for r in api.planned_requests(mode, [g])
+                            if not (journal.contains(*r) or api.cache.contains(*r))])
+            costs = {id(g) : _cost(g) for g in plan}
+            num_requests = sum(costs.values())
+
+            # リクエスト数が予算を超える場合は古いデータから優先して取得し、残りは次回に回す
+            available = api.limiter.remaining()
+            if budget is not None:
+                available = budget if available is None else min(available, budget)
+            if available is not None and num_requests > available:
+                policy = BCRefreshPolicy(mode, outdir, self.__market_caps())
+                plan, deferred = policy.select(plan, available, api.num_year(), lambda g: costs[id(g)])
+                num_deferred = sum([len(ts) for ts, _, _ in deferred])
+                logger.warn(f"{num_requests} requests are needed but only {available} are available:"
+                            f" {num_deferred} less stale tickers are deferred to the next run")
+            if dry_run:
+                # estimate() と同じく、キャッシュ・ジャーナルから返せる分は除いて見積もる
+                num_selected = sum([costs[id(g)] for g in plan])
+                self.__forecast(api, mode, sum([len(ts) for ts, _, _ in plan]), num_selected,
+                                len(api.planned_requests(mode, plan)) - num_selected, "dry-run")
+                return [t for ts, _, _ in deferred for t in ts]
+
+            def _on_fetched(ticker, df, col_dict):
+                if mode != "indicator":
+                    planner.observe(mode, ticker, *ranges[ticker], df)
+                _write_csv(ticker, df, col_dict)
 
             # API からデータ取得
-            if mode == "quarter":
-                # 開始は Q1, 終了は Q4 で固定
-                start_q = f"{config['start']}Q1"
-                end_q = f"{config['end']}Q4"
-                api.get_quarter(targets, start_q, end_q, _write_csv, retry)
-            elif mode == "indicator":
-                api.get_indicator(targets, _write_csv, retry)
-            elif mode == "daily":
-                # 開始は 1月1日, 終了は 12月31日で固定
-                start_day = f"{config['start']}-01-01"
-                end_day = f"{config['end']}-12-31"
-                api.get_daily(targets, start_day, end_day, _write_csv, retry)
-
-        # 終わったら全部をまとめた pickle ファイルを作って load しておく
-        BCDataAbs.csvs_to_pickle(outdir)
+            api.journal = journal
+            # 使う分を limiter の quota から確保しておく (他のジョブに先に確保されて足りなければ途中で打ち切る)
+            api.reserve(sum([costs[id(g)] for g in plan]))
+            job = api.stats.start_job(mode)
+            try:
+                if mode == "indicator":
+                    api.get_indicator([t for ts, _, _ in plan for t in ts], _on_fetched, retry)
+                else:
+                    api.get_planned(mode, plan, _on_fetched, retry)
+            except BCExceededFetchError as e:
+                # quota を使い切った。取得できなかった銘柄は次回ジャーナルから再開する
+                done = journal.done_tickers()
+                rest = [g for g in plan if not set(g[0]) <= done]
+                deferred += rest
+                logger.warn(f"{e}: {sum([len(ts) for ts, _, _ in rest])} tickers are deferred to the next run")
+            finally:
+                api.release()
+                api.journal = None
+                manifest.save()
+                planner.save()
+                api.batch.save()
+                # 期限切れのキャッシュを消す (1 日 1 回)
+                api.cache.prune()
+                api.stats.end_job()
+                api.stats.log_summary(job)
+            # 最後まで取得できたらジャーナルは不要 (次回に回した銘柄があれば続きから再開できるよう残す)
+            if not api.stop_fetch and len(deferred) < 1:
+                journal.clear()
+            if not api.stop_fetch:
+                # 取得した銘柄は会社一覧に追加された銘柄の取得待ちから外す
+                self.__done_pending(mode, set(targets) - {t for ts, _, _ in deferred for t in ts})
+
+            self.changed_tickers[mode] = sorted(manifest.changed)
+            logger.info(f"{len(manifest.changed)} tickers changed")
+
+        # 終わったら内容の変わった銘柄だけストアに反映して load しておく
+        if not self.__sync_store(mode):
+            return [t for ts, _, _ in deferred for t in ts]
+        # プロット用キャッシュも作り直す
+        self.plot_caches = pd.DataFrame()
         if mode == "quarter":
             self.load_quarter()
         if mode == "indicator":
             self.load_indicator()
         if mode == "daily":
             self.load_daily()
+        return [t for ts, _, _ in deferred for t in ts]
+
+    def __market_caps(self):
+        """
+        銘柄ごとの時価総額 {銘柄コード: 時価総額}
+
+        company データにあればそれを、なければ indicator (なければ daily) データの最新の値を使う。
+        どれもなければ空。
+        """
+        df = self.company.data
+        if "market_capital" in df.columns:
+            return {int(t) : v for t, v in zip(df["ticker"], df["market_capital"]) if pd.notna(v)}
+        for mode in ["indicator", "daily"]:
+            store = BCDataStore.open(self.root_dir / mode, mode)
+            if not store.exists():
+                continue
+            # 時価総額の列だけ読む
+            df = store.read_frame(columns=["market_capital"])
+            if "market_capital" not in df.columns:
+                return {}
+            last = df.groupby("ticker")["market_capital"].last()
+            return {int(t) : v for t, v in last.items() if pd.notna(v)}
+        return {}
+
+    @staticmethod
+    def __daily_ranges(outdir, tickers, start, end):
+        """
+        daily データの未取得期間 (既存 CSV の最終日の翌日 ～ end) を銘柄ごとに求める
+
+        Parameters
+        ----------
+        outdir : Path
+            daily データの保存先ディレクトリ
+        tickers : list
+            対象銘柄コード
+        start : str
+            CSV がない場合の開始日 (ex. "2017-01-01")
+        end : str
+            終了日 (ex. "2019-12-31")
+
+        Returns
+        -------
+        dict
+            key: 銘柄コード, value: (開始日, 終了日)。取得済みの銘柄は含まない
+        """
+        ranges = {}
+        for t in tickers:
+            s = start
+            p = outdir / f"{t}.csv"
+            if p.exists():
+                try:
+                    days = pd.read_csv(p, usecols=["day"])["day"]
+                    if len(days) > 0:
+                        s = max(start, (date.fromisoformat(days.max()) + timedelta(days=1)).isoformat())
+                except (pd.errors.EmptyDataError, ValueError):
+                    pass
+            if s > end:
+                # 取得済み
+                continue
+            ranges[t] = (s, end)
+        return ranges
+
+    @staticmethod
+    def __quarter_ranges(outdir, tickers, start, end, lookback=0):
+        """
+        四半期データの未取得期間 (既存 CSV の最新四半期の次 ～ end) を銘柄ごとに求める
 
-    def fetch_quarter(self, api, start, end, retry=-1, overwrite=False):
+        Parameters
+        ----------
+        outdir : Path
+            四半期データの保存先ディレクトリ
+        tickers : list
+            対象銘柄コード
+        start : str
+            CSV がない場合の開始四半期 (ex. "2012Q1")
+        end : str
+            終了四半期 (ex. "2015Q4")
+        lookback : int
+            最新四半期から何四半期さかのぼって再取得するか
+
+        Returns
+        -------
+        dict
+            key: 銘柄コード, value: (開始四半期, 終了四半期)。取得済みの銘柄は含まない
+        """
+        # 四半期を通し番号で扱う
+        def __to_n(s):
+            y, q = [int(v) for v in s.split("Q")]
+            return y * 4 + q - 1
+        def __to_str(n):
+            return f"{n // 4}Q{n % 4 + 1}"
+
+        start_n = __to_n(start)
+        end_n = __to_n(end)
+        ranges = {}
+        for t in tickers:
+            s = start_n
+            p = outdir / f"{t}.csv"
+            if p.exists():
+                try:
+                    df = pd.read_csv(p, usecols=["fiscal_year", "fiscal_quarter"])
+                    if len(df) > 0:
+                        latest = int((df["fiscal_year"] * 4 + df["fiscal_quarter"] - 1).max())
+                        s = max(start_n, latest + 1 - lookback)
+                except (pd.errors.EmptyDataError, ValueError):
+                    pass
+            if s > end_n:
+                # 取得済み
+                continue
+            ranges[t] = (__to_str(s), end)
+        return ranges
+
+    def fetch_quarter(self, api, start, end, retry=-1, overwrite=False, incremental=False, lookback=2, added_only=False, dry_run=False, budget=None):
         """API 四半期データ取得関数
 
         API でデータを取得し、指定ディレクトリ以下に
          * {銘柄コード}.csv
          * columns.json     # 列名定義
-         * all.pickle       # 全銘柄分を連結した dataframe
+         * store/           # 全銘柄分をまとめたもの (BCDataStore)
          を出力する。
 
         Parameters
@@ -553,42 +1841,71 @@ class BCData:
         end : str
             終了年 (ex. "2015")
         retry : int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係な 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
         overwrite: bool
             既存の CSV を上書きするか
+        incremental: bool
+            True なら既存 CSV の最新四半期より後 (lookback 分さかのぼる) だけを取得し、既存 CSV にマージする。
+            CSV のない銘柄は start から取得する。
+        lookback: int
+            incremental の場合に、最新四半期から何四半期さかのぼって再取得するか (修正反映用)
+        added_only: bool
+            True なら会社一覧に追加されて (fetch_company() で検出) まだ取得していない銘柄だけを取得する
+        dry_run: bool
+            True なら取得せず、リクエスト数と所要時間の見込みをログ出力するだけ
+        budget: int
+            今回使うリクエスト数の上限。None なら quota の残り。
+            足りない場合はデータの古い銘柄から取得し、残りは次回の取得に回す
+
+        Returns
+        -------
+        list
+            予算不足で次回に回した銘柄コード
         """
-        self.__fetch_elem("quarter", api, retry, overwrite, config={"start":start, "end":end})
+        return self.__fetch_elem("quarter", api, retry, overwrite, config={"start":start, "end":end, "incremental":incremental, "lookback":lookback, "added_only":added_only}, dry_run=dry_run, budget=budget)
 
-    def fetch_indicator(self, api, retry=-1, overwrite=False):
+    def fetch_indicator(self, api, retry=-1, overwrite=False, added_only=False, dry_run=False, budget=None):
         """API 指標データ取得関数
 
         API でデータを取得し、指定ディレクトリ以下に
          * {銘柄コード}.csv
          * columns.json     # 列名定義
-         * all.pickle       # 全銘柄分を連結した dataframe
+         * store/           # 全銘柄分をまとめたもの (BCDataStore)
          を出力する。
 
         Parameters
         ----------
         api : BCAPI インスタンス
         retry : int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係なく 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
         overwrite: bool
             既存の各 CSV データを上書きするか
+        added_only: bool
+            True なら会社一覧に追加されて (fetch_company() で検出) まだ取得していない銘柄だけを取得する
+        dry_run: bool
+            True なら取得せず、リクエスト数と所要時間の見込みをログ出力するだけ
+        budget: int
+            今回使うリクエスト数の上限。None なら quota の残り。
+            足りない場合はデータの古い銘柄から取得し、残りは次回の取得に回す
+
+        Returns
+        -------
+        list
+            予算不足で次回に回した銘柄コード
         """
-        self.__fetch_elem("indicator", api, retry, overwrite, config={})
+        return self.__fetch_elem("indicator", api, retry, overwrite, config={"added_only":added_only}, dry_run=dry_run, budget=budget)
 
-    def fetch_daily(self, api, start, end, retry=-1, overwrite=False):
+    def fetch_daily(self, api, start, end, retry=-1, overwrite=False, incremental=False, added_only=False, dry_run=False, budget=None):
         """API 四半期データ取得関数
 
         API でデータを取得し、指定ディレクトリ以下に
          * {銘柄コード}.csv
          * columns.json     # 列名定義
-         * all.pickle       # 全銘柄分を連結した dataframe
+         * store/           # 全銘柄分をまとめたもの (BCDataStore)
          を出力する。
 
         Parameters
@@ -599,13 +1916,95 @@ class BCData:
         end : str
             終了年 (ex. "2019")
         retry : int
-            エラーが起きた場合のリトライ間隔 [minites]
+            エラーが起きた場合のリトライ待ち時間の上限 [minites]
             負数ならリトライしない。
-            NOTE: 取得制限に引っかかった場合はこの値とは関係な 24h 待つ。
+            NOTE: 取得制限に引っかかった場合はこの値とは関係なく quota のリセットまで (不明なら 24h) 待つ。
         overwrite: bool
             既存の CSV を上書きするか
+        incremental: bool
+            True なら既存 CSV の最終日の翌日から今日 (end 年末より前なら) までだけを取得し、既存 CSV にマージする。
+            CSV のない銘柄は start から取得する。
+        added_only: bool
+            True なら会社一覧に追加されて (fetch_company() で検出) まだ取得していない銘柄だけを取得する
+        dry_run: bool
+            True なら取得せず、リクエスト数と所要時間の見込みをログ出力するだけ
+        budget: int
+            今回使うリクエスト数の上限。None なら quota の残り。
+            足りない場合はデータの古い銘柄から取得し、残りは次回の取得に回す
+
+        Returns
+        -------
+        list
+            予算不足で次回に回した銘柄コード
+        """
+        return self.__fetch_elem("daily", api, retry, overwrite, config={"start":start, "end":end, "incremental":incremental, "added_only":added_only}, dry_run=dry_run, budget=budget)
+
+    def estimate(self, api, mode, start=None, end=None, overwrite=False, incremental=False, lookback=2, added_only=False):
         """
-        self.__fetch_elem("daily", api, retry, overwrite, config={"start":start, "end":end})
+        取得にかかるリクエスト数・時間・quota の見込みを求める (API は呼ばない)
+
+        fetch_xxx() と同じ引数で、会社一覧と既存の CSV・ジャーナル・キャッシュから取得計画を立て、
+        get_xxx() と同じように小分けした場合に実際に API に投げるリクエストを数える。
+
+        Parameters
+        ----------
+        api : BCAPI インスタンス
+            limiter (レート・quota) と銘柄数・年数の設定を使う
+        mode : str
+            "company" or "quarter" or "indicator" or "daily"
+        start, end, overwrite, incremental, lookback, added_only :
+            fetch_xxx() と同じ
+
+        Returns
+        -------
+        dict
+            * mode : str
+            * num_tickers : 取得対象の銘柄数
+            * num_requests : API に投げるリクエスト数
+            * num_cached : キャッシュ・ジャーナルから返せるのでリクエストしない数
+            * duration : limiter のレートでの所要時間 [sec] (quota のリセット待ちを含まない)
+            * finish : quota のリセット待ちを含めた終了見込み時刻
+            * exhausted : 今の quota 期間の quota を使い切る見込み時刻 (使い切らないなら None)
+            * num_days : 使う quota 期間の数
+        """
+        self.__attach_cache(api)
+        journal = None
+        if mode == "company":
+            num_tickers = 0
+            exists = (self.root_dir / "company" / "company.csv").exists()
+            requests = [] if exists and not overwrite else [("company", {})]
+        else:
+            if mode == "quarter":
+                config = {"start":start, "end":end, "incremental":incremental, "lookback":lookback, "added_only":added_only}
+            elif mode == "daily":
+                config = {"start":start, "end":end, "incremental":incremental, "added_only":added_only}
+            else:
+                config = {"added_only":added_only}
+            _, journal, targets, _, _, plan = self.__plan(mode, api, overwrite, config, readonly=True)
+            num_tickers = len(targets)
+            requests = api.planned_requests(mode, plan) if plan is not None else []
+
+        num_cached = len([r for r in requests
+                          if (journal is not None and journal.contains(*r)) or api.cache.contains(*r)])
+        return self.__forecast(api, mode, num_tickers, len(requests) - num_cached, num_cached, "estimate")
+
+    @staticmethod
+    def __forecast(api, mode, num_tickers, num_requests, num_cached, tag):
+        """estimate() の結果を作ってログ出力する (fetch_xxx(dry_run=True) でも使う)"""
+        result = {
+            "mode" : mode,
+            "num_tickers" : num_tickers,
+            "num_requests" : num_requests,
+            "num_cached" : num_cached,
+            "duration" : num_requests / api.limiter.rate,
+            **api.limiter.project(num_requests),
+        }
+        logger.info(f"[{tag}] {mode}: {num_requests} requests ({num_cached} cached) for {num_tickers} tickers,"
+                    f" duration: {timedelta(seconds=round(result['duration']))}, finish: {result['finish']:%Y-%m-%d %H:%M},"
+                    f" quota days: {result['num_days']}")
+        if result["exhausted"] is not None:
+            logger.warn(f"[{tag}] {mode}: daily quota will be used up at {result['exhausted']:%Y-%m-%d %H:%M}")
+        return result
 
     def get_plot_values(self, val_dict):
         """
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+#   Copyright 2020 Sarubee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+bc_mock.py
+ - バフェットコード API のローカル代替サーバー (オフラインでのテスト・ベンチマーク用)
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+from dateutil.relativedelta import relativedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, urljoin
+import requests
+import logging
+logger = logging.getLogger(__name__)
+
+from bc_api import BCAPI, BCResponseCache
+
+class BCMockData:
+    """
+    本物と同じ形式の合成データを作る
+
+    値は銘柄コードと期間から決まるので、何度取得しても同じデータになる。
+    上場年より前の期間はデータなしになる。
+    """
+
+    COLUMNS = {
+        "company" : {
+            "company_name" : {"name_jp" : "会社名", "unit" : ""},
+            "company_name_en" : {"name_jp" : "会社名 (英語)", "unit" : ""},
+            "tosyo_33category" : {"name_jp" : "東証33業種", "unit" : ""},
+            "url" : {"name_jp" : "会社URL", "unit" : ""},
+            "listing_date" : {"name_jp" : "上場年月日", "unit" : ""},
+        },
+        "quarter" : {
+            "fiscal_year" : {"name_jp" : "会計年度", "unit" : ""},
+            "fiscal_quarter" : {"name_jp" : "四半期", "unit" : ""},
+            "edinet_updated_at" : {"name_jp" : "EDINET 提出日", "unit" : ""},
+            "net_sales" : {"name_jp" : "売上高", "unit" : "百万円"},
+            "operating_income" : {"name_jp" : "営業利益", "unit" : "百万円"},
+            "net_income" : {"name_jp" : "純利益", "unit" : "百万円"},
+            "assets" : {"name_jp" : "総資産", "unit" : "百万円"},
+        },
+        "indicator" : {
+            "day" : {"name_jp" : "日付", "unit" : ""},
+            "stockprice" : {"name_jp" : "株価", "unit" : "円"},
+            "market_capital" : {"name_jp" : "時価総額", "unit" : "百万円"},
+            "pbr" : {"name_jp" : "PBR", "unit" : "倍"},
+            "per_forecast" : {"name_jp" : "予想PER", "unit" : "倍"},
+            "dividend_yield_forecast" : {"name_jp" : "予想配当利回り", "unit" : "%"},
+            "dividend_payout_ratio" : {"name_jp" : "配当性向", "unit" : "%"},
+        },
+        "daily" : {
+            "day" : {"name_jp" : "日付", "unit" : ""},
+            "close_price" : {"name_jp" : "終値", "unit" : "円"},
+            "market_capital" : {"name_jp" : "時価総額", "unit" : "百万円"},
+            "pbr" : {"name_jp" : "PBR", "unit" : "倍"},
+            "per" : {"name_jp" : "PER", "unit" : "倍"},
+        },
+    }
+
+    CATEGORIES = ["水産・農林業", "建設業", "食料品", "化学", "医薬品", "電気機器", "輸送用機器", "情報・通信業", "銀行業", "サービス業"]
+
+    def __init__(self, tickers=None, seed=0):
+        """
+        Parameters
+        ----------
+        tickers : list
+            銘柄コード。省略時は 1301 から 100 銘柄
+        seed : int
+            乱数シード
+        """
+        self.tickers = sorted(tickers) if tickers is not None else list(range(1301, 1401))
+        self.seed = seed
+
+    def __rand(self, *keys):
+        # NOTE: hash() はプロセスごとに変わるので文字列で seed を指定する
+        return random.Random(":".join([str(k) for k in (self.seed,) + keys]))
+
+    def listing_year(self, ticker):
+        return 2005 + int(ticker) % 15
+
+    def company(self):
+        d = {}
+        for t in self.tickers:
+            r = self.__rand("company", t)
+            d[str(t)] = [{
+                "company_name" : f"テスト{t}",
+                "company_name_en" : f"Test {t} Co., Ltd.",
+                "tosyo_33category" : r.choice(BCMockData.CATEGORIES),
+                "url" : f"https://example.com/{t}",
+                "listing_date" : f"{self.listing_year(t)}-04-01",
+            }]
+        return d
+
+    def quarter(self, tickers, start, end):
+        sy, sq = [int(s) for s in start.split("Q")]
+        ey, eq = [int(s) for s in end.split("Q")]
+        d = {}
+        for t in tickers:
+            l = []
+            for n in range(sy * 4 + sq - 1, ey * 4 + eq):
+                y, q = n // 4, n % 4 + 1
+                # 3月決算として、四半期末の 45 日後に提出されたことにする
+                m = q * 3 + 3
+                submitted = date(y + (m - 1) // 12, (m - 1) % 12 + 1, 1) + timedelta(days=75)
+                if y < self.listing_year(t) or submitted > date.today():
+                    continue
+                r = self.__rand("quarter", t, y)
+                sales = r.uniform(1e3, 1e6) * q / 4
+                l.append({
+                    "fiscal_year" : y,
+                    "fiscal_quarter" : q,
+                    "edinet_updated_at" : submitted.isoformat(),
+                    "net_sales" : round(sales, 1),
+                    "operating_income" : round(sales * r.uniform(-0.05, 0.2), 1),
+                    "net_income" : round(sales * r.uniform(-0.05, 0.1), 1),
+                    "assets" : round(sales * r.uniform(1, 3), 1),
+                })
+            d[str(t)] = l
+        return d
+
+    def indicator(self, tickers):
+        d = {}
+        for t in tickers:
+            r = self.__rand("indicator", t)
+            d[str(t)] = [{
+                "day" : date.today().isoformat(),
+                "stockprice" : round(r.uniform(100, 10000)),
+                "market_capital" : round(r.uniform(1e3, 1e7), 1),
+                "pbr" : round(r.uniform(0.3, 10), 2),
+                "per_forecast" : round(r.uniform(3, 60), 2),
+                "dividend_yield_forecast" : round(r.uniform(0, 6), 2),
+                "dividend_payout_ratio" : round(r.uniform(0, 100), 2),
+            }]
+        return d
+
+    def daily(self, tickers, start, end):
+        s = date.fromisoformat(start)
+        e = min(date.fromisoformat(end), date.today())
+        d = {}
+        for t in tickers:
+            l = []
+            price = self.__rand("daily", t).uniform(100, 10000)
+            day = max(s, date(self.listing_year(t), 4, 1))
+            while day <= e:
+                if day.weekday() < 5:
+                    r = self.__rand("daily", t, day.toordinal())
+                    p = round(price * (1 + 0.3 * r.uniform(-1, 1)))
+                    l.append({
+                        "day" : f"{day.isoformat()}T00:00:00+09:00",
+                        "close_price" : p,
+                        "market_capital" : round(p * 1e3, 1),
+                        "pbr" : round(r.uniform(0.3, 10), 2),
+                        "per" : round(r.uniform(3, 60), 2),
+                    })
+                day += timedelta(days=1)
+            d[str(t)] = l
+        return d
+
+class BCMockServer:
+    """
+    バフェットコード API の代替サーバー
+
+    以下の動作モードがある。
+     * 合成データ: BCMockData のデータを返す
+     * replay: fixtures_dir に記録済みのレスポンスがあればそれを返す (なければ合成データ)
+     * record: record_key を指定すると本物の API に問い合わせ、結果を fixtures_dir に記録してから返す
+
+    BCAPI(api_key, url_api=server.url) のように接続先を差し替えて使う。
+
+    Attributes
+    ----------
+    url : str
+        API の URL (BCAPI.URL_API 相当)
+    num_requests : int
+        受け付けたリクエスト数
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, data=None, quota=None, latency=0.0,
+                 fixtures_dir=None, record_key=None, record_url=BCAPI.URL_API,
+                 max_num_company=BCAPI.MAX_NUM_COMPANY, max_num_year=BCAPI.MAX_NUM_YEAR):
+        """
+        Parameters
+        ----------
+        host : str
+        port : int
+            0 なら空いているポートを使う
+        data : BCMockData
+            合成データ。省略時はデフォルト設定の BCMockData
+        quota : int
+            このリクエスト数を超えたら "Limit Exceeded" を返す。None なら無制限
+        latency : float
+            レスポンスを返すまでの待ち時間 [sec]
+        fixtures_dir : str or Path
+            記録済みレスポンスの置き場所
+        record_key : str
+            指定されていれば本物の API からレスポンスを取得して記録する (API キー)
+        record_url : str
+            record モードでの取得元
+        max_num_company : int
+            1 リクエストで指定できる銘柄数
+        max_num_year : int
+            quarter の 1 リクエストで指定できる年数
+        """
+        self.data = data if data is not None else BCMockData()
+        self.quota = quota
+        self.latency = latency
+        self.fixtures_dir = Path(fixtures_dir) if fixtures_dir is not None else None
+        self.record_key = record_key
+        self.record_url = record_url
+        self.max_num_company = max_num_company
+        self.max_num_year = max_num_year
+
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+        server = self
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive
+            def do_GET(self):
+                u = urlparse(self.path)
+                endpoint = u.path.rstrip("/").split("/")[-1]
+                params = {k : v[0] for k, v in parse_qs(u.query).items()}
+                status, d = server.respond(endpoint, params, self.headers.get("x-api-key"))
+                body = json.dumps(d, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/v2/"
+
+    def __fixture_path(self, endpoint, params):
+        return self.fixtures_dir / endpoint / f"{BCResponseCache.key(endpoint, params)}.json"
+
+    def __check_params(self, endpoint, params):
+        """本物の API と同じ制限をチェック。問題があればエラーメッセージを返す"""
+        tickers = [t for t in params.get("tickers", "").split(",") if t != ""]
+        if endpoint == "company":
+            return None
+        if len(tickers) < 1:
+            return "tickers is required"
+        if len(tickers) > self.max_num_company:
+            return f"Too many tickers (max: {self.max_num_company})"
+        try:
+            if endpoint == "quarter":
+                sy, sq = [int(s) for s in params["from"].split("Q")]
+                ey, eq = [int(s) for s in params["to"].split("Q")]
+                if (ey * 4 + eq) - (sy * 4 + sq) >= self.max_num_year * 4:
+                    return f"Too long period (max: {self.max_num_year} years)"
+            elif endpoint == "daily":
+                s = date.fromisoformat(params["from"])
+                e = date.fromisoformat(params["to"])
+                # BCAPI の小分けと同じく 2/29 からの 1 年は 2/28 まで
+                if e >= s + relativedelta(years=1):
+                    return "Too long period (max: 1 year)"
+        except (KeyError, ValueError):
+            return "Invalid period"
+        return None
+
+    def respond(self, endpoint, params, api_key):
+        """
+        リクエストに対する (HTTP ステータス, レスポンス) を返す
+        """
+        with self.lock:
+            self.num_requests += 1
+            n = self.num_requests
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if api_key is None:
+            return 403, {"message" : "Forbidden"}
+        if self.quota is not None and n > self.quota:
+            return 429, {"message" : "Limit Exceeded"}
+        if endpoint not in BCMockData.COLUMNS:
+            return 404, {"message" : "Not Found"}
+        msg = self.__check_params(endpoint, params)
+        if msg is not None:
+            return 400, {"message" : msg}
+
+        # 記録済みのレスポンス
+        if self.fixtures_dir is not None:
+            p = self.__fixture_path(endpoint, params)
+            if self.record_key is not None:
+                d = self.__record(endpoint, params, p)
+                return (400 if "message" in d else 200), d
+            if p.exists():
+                with open(p, "r") as f:
+                    return 200, json.load(f)
+
+        # 合成データ
+        tickers = [int(t) for t in params.get("tickers", "").split(",") if t != ""]
+        if endpoint == "company":
+            d = self.data.company()
+        elif endpoint == "quarter":
+            d = self.data.quarter(tickers, params["from"], params["to"])
+        elif endpoint == "indicator":
+            d = self.data.indicator(tickers)
+        elif endpoint == "daily":
+            d = self.data.daily(tickers, params["from"], params["to"])
+        d["column_description"] = BCMockData.COLUMNS[endpoint]
+        return 200, d
+
+    def __record(self, endpoint, params, p):
+        """本物の API から取得して記録"""
+        logger.info(f"recording {endpoint} ({params}) ...")
+        d = requests.get(urljoin(self.record_url, endpoint), params=params, headers={"x-api-key" : self.record_key}).json()
+        if "message" not in d:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            with open(p, "w") as f:
+                json.dump(d, f, ensure_ascii=False)
+        return d
+
+    def start(self):
+        """別スレッドでサーバーを開始"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"mock server started at {self.url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level = logging.INFO,
+        format = "[%(asctime)s][%(levelname)s] %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(description="local mock server of Buffett Code API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--num-tickers", type=int, default=100, help="number of synthetic tickers")
+    parser.add_argument("--quota", type=int, default=None, help="return 'Limit Exceeded' after this number of requests")
+    parser.add_argument("--latency", type=float, default=0.0, help="response latency [sec]")
+    parser.add_argument("--fixtures", default=None, help="directory of recorded responses (replay)")
+    parser.add_argument("--record", default=None, metavar="KEY_FILE", help="record responses of the real API into --fixtures")
+    args = parser.parse_args()
+
+    record_key = None
+    if args.record is not None:
+        if args.fixtures is None:
+            parser.error("--record requires --fixtures")
+        with open(args.record) as f:
+            record_key = f.read().strip()
+
+    server = BCMockServer(args.host, args.port,
+                          data=BCMockData(list(range(1301, 1301 + args.num_tickers))),
+                          quota=args.quota, latency=args.latency,
+                          fixtures_dir=args.fixtures, record_key=record_key)
+    logger.info(f"serving at {server.url} ...")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+#   Copyright 2020 Sarubee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+bc_scheduler.py
+ - 複数の fetch ジョブ (データディレクトリ違いも可) を共有の rate limiter のもとで優先度順に並行実行する
+"""
+
+import threading
+import itertools
+from pathlib import Path
+import logging
+logger = logging.getLogger(__name__)
+
+from bc_api import BCAPI, BCRateLimiter, BCRequestCoalescer, BCResponseCache
+from bc_data import BCData
+
+class BCFetchJob:
+    """
+    fetch ジョブ
+
+    Attributes
+    ----------
+    root_dir : Path
+        データディレクトリ
+    mode : str
+        "company" or "quarter" or "indicator" or "daily"
+    priority : int
+        優先度 (大きいほど優先)
+    kwargs : dict
+        BCData.fetch_{mode}() に渡す引数 (start, end, retry, overwrite など)
+    status : str
+        "pending", "running", "done", "stopped", "failed", "cancelled" のいずれか
+    error : Exception
+        失敗した場合の例外
+    result :
+        BCData.fetch_{mode}() の戻り値 (quarter, indicator, daily なら予算不足で次回に回した銘柄コード)
+    api : BCAPI
+        実行中・実行後のジョブが使う BCAPI (統計は api.stats)
+    """
+
+    MODES = ("company", "quarter", "indicator", "daily")
+
+    def __init__(self, root_dir, mode, priority=0, **kwargs):
+        if mode not in BCFetchJob.MODES:
+            raise RuntimeError(f"invalid mode {mode}")
+        self.root_dir = Path(root_dir).resolve()
+        self.mode = mode
+        self.priority = priority
+        self.kwargs = kwargs
+        self.status = "pending"
+        self.error = None
+        self.result = None
+        self.api = None
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """ジョブの終了を待つ。終了していれば True"""
+        return self.finished.wait(timeout)
+
+    def __repr__(self):
+        return f"BCFetchJob({str(self.root_dir)!r}, {self.mode!r}, priority={self.priority}, status={self.status!r})"
+
+class BCFetchScheduler:
+    """
+    fetch ジョブのスケジューラ
+
+    * 全ジョブで 1 つの BCRateLimiter を共有し、リクエストの枠は優先度の高いジョブから渡す
+    * 複数のジョブが同時に同じリクエスト (endpoint, 銘柄, 期間) を投げようとしたら 1 回だけ投げる
+    * レスポンスのキャッシュも全ジョブで共有し、時間がずれて同じリクエストをする場合も API を呼ばない
+    * 同じデータディレクトリのジョブは順番に実行する (company のジョブは他より先)
+
+    Examples
+    --------
+    >>> with BCFetchScheduler(api_key, limiter=BCRateLimiter(daily_quota=5000)) as scheduler:
+    ...     scheduler.submit("data_a", "quarter", priority=1, start="2015", end="2020")
+    ...     scheduler.submit("data_b", "quarter", start="2018", end="2020")
+    """
+
+    def __init__(self, api_key, limiter=None, max_jobs=2, cache_dir=None, **api_kwargs):
+        """
+        Parameters
+        ----------
+        api_key : str
+            API キー
+        limiter : BCRateLimiter
+            全ジョブで共有するリクエスト制限。省略時は 1 リクエスト/秒、quota なし
+        max_jobs : int
+            同時に実行するジョブの最大数
+        cache_dir : str or Path
+            全ジョブで共有するレスポンスのキャッシュの保存先。省略時は最初に追加したジョブのデータディレクトリの cache/
+        api_kwargs : dict
+            各ジョブの BCAPI に渡すその他の引数 (num_workers, url_api など)
+        """
+        self.api_key = api_key
+        self.limiter = limiter if limiter is not None else BCRateLimiter()
+        self.coalescer = BCRequestCoalescer()
+        self.cache = BCResponseCache(cache_dir) if cache_dir is not None else None
+        self.max_jobs = max_jobs
+        self.api_kwargs = api_kwargs
+
+        self.cond = threading.Condition()
+        self.pending = [] # (-優先度, 順番, ジョブ)
+        self.running = []
+        self.__seq = itertools.count()
+        self.stopped = False
+        self.closing = False
+        self.thread = None
+
+    def submit(self, root_dir, mode, priority=0, **kwargs):
+        """
+        ジョブを追加する
+
+        Parameters
+        ----------
+        root_dir : str or Path
+            データディレクトリ
+        mode : str
+            "company" or "quarter" or "indicator" or "daily"
+        priority : int
+            優先度 (大きいほど優先)
+        kwargs : dict
+            BCData.fetch_{mode}() に渡す引数
+
+        Returns
+        -------
+        BCFetchJob
+        """
+        job = BCFetchJob(root_dir, mode, priority, **kwargs)
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError(f"scheduler is stopped")
+            if self.cache is None:
+                self.cache = BCResponseCache(job.root_dir / "cache")
+            self.pending.append((-priority, next(self.__seq), job))
+            self.cond.notify_all()
+        return job
+
+    def start(self):
+        """別スレッドでジョブの実行を開始する"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__dispatch, daemon=True)
+            self.thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """投入済みのジョブがすべて終わるのを待つ。終わっていれば True"""
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.pending) < 1 and len(self.running) < 1, timeout)
+
+    def stop(self):
+        """未実行のジョブを取り消し、実行中のジョブを中断する"""
+        with self.cond:
+            self.stopped = True
+            for _, _, job in self.pending:
+                job.status = "cancelled"
+                job.finished.set()
+            self.pending = []
+            for job in self.running:
+                job.api.stop()
+            self.cond.notify_all()
+
+    def shutdown(self, wait=True):
+        """スケジューラを終了する。wait なら実行中のジョブの終了を待つ"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if wait and self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.stop()
+        self.wait()
+        self.shutdown()
+
+    def __next_job(self):
+        """次に実行するジョブ。実行できるものがなければ None (self.cond を取った状態で呼ぶ)"""
+        busy = {job.root_dir for job in self.running}
+        for _, _, job in sorted(self.pending, key=lambda e: e[:2]):
+            if job.root_dir in busy:
+                continue
+            if job.mode != "company" and any([j.root_dir == job.root_dir and j.mode == "company" for _, _, j in self.pending]):
+                continue
+            return job
+        return None
+
+    def __dispatch(self):
+        with self.cond:
+            while True:
+                while not self.stopped and len(self.running) < self.max_jobs:
+                    job = self.__next_job()
+                    if job is None:
+                        break
+                    self.pending = [e for e in self.pending if e[2] is not job]
+                    job.api = BCAPI(self.api_key, limiter=self.limiter, coalescer=self.coalescer, cache=self.cache,
+                                    priority=job.priority, **self.api_kwargs)
+                    job.status = "running"
+                    self.running.append(job)
+                    threading.Thread(target=self.__run, args=(job,), daemon=True).start()
+                if self.closing and len(self.running) < 1 and (self.stopped or len(self.pending) < 1):
+                    return
+                self.cond.wait()
+
+    def __run(self, job):
+        logger.info(f"START {job.mode} job ({job.root_dir}, priority: {job.priority})")
+        try:
+            data = BCData(job.root_dir)
+            job.result = getattr(data, f"fetch_{job.mode}")(job.api, **job.kwargs)
+            job.status = "stopped" if job.api.stop_fetch else "done"
+        except Exception as e:
+            logger.exception(e)
+            job.error = e
+            job.status = "failed"
+        finally:
+            job.api.close()
+            with self.cond:
+                self.running.remove(job)
+                self.cond.notify_all()
+            job.finished.set()
+        logger.info(f"END {job.mode} job ({job.root_dir}): {job.status}")